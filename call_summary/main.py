@@ -37,12 +37,11 @@ async def handleCallDidEnd(msg):
     summary_resp = await message_center.send_message(save_msg)
     remynd.log(summary_resp)
 
-# Handler for incoming events on the 'calls' channel
+# Handler for 'callDidEnd' events on the 'calls' channel
 async def call_handler(channel, event, msg):
-    if event == 'callDidEnd':
-        await handleCallDidEnd(msg)
+    await handleCallDidEnd(msg)
 
 # Register event handler and start the message center
-message_center.subscribe('calls', call_handler)
+message_center.subscribe('calls', 'callDidEnd', call_handler)
 remynd.log("Waiting for video calls...")
 message_center.run() # Will run forever
@@ -3,7 +3,7 @@ import asyncio
 import json
 import time
 import os
-import sys
+import functools
 from datetime import datetime, timezone
 from base64 import b64encode
 
@@ -16,7 +16,10 @@ env = Environment(
 # Create a MessageCenter instance
 loop = asyncio.get_event_loop()
 message_center = remynd.MessageCenter(loop)
-kvstore = remynd.Dictionary(message_center.extension_id)
+kvstore = remynd.Dictionary(message_center.extension_id, cache=True, write_behind=True)
+# Call rows and rendered transcription/summary fragments by call id and version (see
+# callVersion), kept in Redis for a week but outside kvstore's unbounded local cache
+fragments = remynd.LRUCache(maxsize=64, store=remynd.Dictionary(message_center.extension_id), ttl=7 * 86400)
 
 def get_time():
     return time.time()
@@ -52,7 +55,7 @@ async def register():
     }
 
     reg_resp = await message_center.send_message(reg_msg)
-    remynd.log("Registration:", json.dumps(reg_resp, indent=4))
+    remynd.log("Registration:", remynd.lazy(json.dumps, reg_resp, indent=4))
 
     await kvstore.remove('entity')
     await kvstore.remove('window_id')
@@ -85,6 +88,8 @@ async def set_locale():
 
     remynd.log("WARNING: Unable to set locale!")
 
+# assets don't change while running, read each one once
+@functools.lru_cache(maxsize=None)
 def encode_image(path):
     with open(os.path.dirname(__file__) + '/' + path, "rb") as f:
         return b64encode(f.read()).decode('ascii')
@@ -95,64 +100,55 @@ env.globals['dateStr'] = date_str
 env.globals['timeStr'] = time_str
 env.globals['dumps'] = json.dumps
 
-async def getTranscription(call_id):
-    transcription = []
+# Renders a template off the event loop (templates read images from disk and can be large)
+async def render(name, **context):
+    return await remynd.run_blocking(lambda: env.get_template(name).render(**context))
+
+# segments per sql.runSQL request, keep it within the app's row limit for one result
+TRANSCRIPTION_PAGE_SIZE = 100
+
+# Yields the transcription of a call one page of segments at a time, paging on id
+async def iterTranscription(call_id, page_size=TRANSCRIPTION_PAGE_SIZE):
     count = 1
     last_id = -1
 
     while True:
-        msg = {
-            "event": "sql.runSQL",
-            "data": {
-                "sql": f"select * from TranscriptionSegment where callID = {call_id} and id > {last_id} order by id",
-                "db": "extras"
-            }
-        }
         remynd.log(f"Sending sql request for transcription {count}...")
-        response = await message_center.send_message(msg)
-        result = response.get('result')
+        result = await remynd.sql(message_center,
+            "select id, startTimestamp, text from TranscriptionSegment where callID = ? and id > ? order by id limit ?",
+            (call_id, last_id, page_size), db="extras")
         count += 1
 
         if not result:
-            break;
-    
-        transcription += result
+            return
+
+        yield result
+
+        if len(result) < page_size:
+            return
         last_id = result[-1]['id']
-        
+
+async def getTranscription(call_id):
+    transcription = []
+    async for page in iterTranscription(call_id):
+        transcription += page
     return transcription
 
 async def checkTranscription(call_id):
-    msg = {
-        "event": "sql.runSQL",
-        "data": {
-            "sql": f"select * from TranscriptionSegment where callID = {call_id} limit 1",
-            "db": "extras"
-        }
-    }
     remynd.log(f"Sending sql request for transcription...")
-    response = await message_center.send_message(msg)
-    result = response.get('result')
+    result = await remynd.sql(message_center, "select id from TranscriptionSegment where callID = ? limit 1", (call_id,), db="extras")
 
     return bool(result)
 
 async def getCallEdgeIds():
-    msg = {
-        "event": "sql.runSQL",
-        "data": {
-            "sql": f"select min(id), max(id) from Call",
-            "db": "extras"
-        }
-    }
-
     remynd.log(f"Sending sql request for max/min call ids...")
-    response = await message_center.send_message(msg)
-    result = response.get('result')
+    result = await remynd.sql(message_center, "select min(id) as min_id, max(id) as max_id from Call", db="extras")
 
     if not result:
         return
     
-    await kvstore.set_int('min_call_id', result[0]['min(id)'])
-    await kvstore.set_int('max_call_id', result[0]['max(id)'])
+    await kvstore.set_int('min_call_id', result[0]['min_id'])
+    await kvstore.set_int('max_call_id', result[0]['max_id'])
 
 ui_lock = asyncio.Lock()
 
@@ -167,7 +163,7 @@ async def showWindow(html, prev=None, next=None, tag="main"):
                 "reopen": True,
                 "windowTag": tag,
 
-                "backEnabled": bool(await kvstore.get('history')),
+                "backEnabled": bool(await kvstore.length('history')),
             }
         }
 
@@ -241,8 +237,10 @@ async def showCallWindow(call, audio_url=None, offset=0, tab=None, no_push=False
     # workaround to remove (host), (me), etc
     # people_set = set()
 
-    template = env.get_template("call.html")
-    html = template.render(title=(call.get('title') or f"Call {call['id']}"), call=call, audio_src=audio_url, offset=offset, tab=tab)
+    if call.get('endDate') and audio_url == f"ext://call.audio?id={call['id']}" and not offset:
+        html = await renderCallWindow(call, tab)
+    else:
+        html = await render("call.html", title=(call.get('title') or f"Call {call['id']}"), call=call, audio_src=audio_url, offset=offset, tab=tab)
 
     # TODO: need to be more specific about prev/next availability
     min_id = await kvstore.get_int('min_call_id')
@@ -257,35 +255,93 @@ async def showCallWindow(call, audio_url=None, offset=0, tab=None, no_push=False
     if jump_to and prev_entity != entity:
         await viewPosition(call['startDate'], frame="trailing")
 
-async def getCall(call_id, next=False, prev=False):
-    msg = {
-        "event": "sql.runSQL",
-        "data": {
-            "sql": f"select * from Call where id = '{call_id}'",
-            "db": "extras"
-        }
-    }
+# Window of a finished call with the default audio source and offset, cached
+async def renderCallWindow(call, tab=None):
+    key = f"window:{call['id']}:{await callVersion(call['id'])}:{tab}"
+    html = await fragments.get(key)
+    if html is None:
+        html = await render("call.html", title=(call.get('title') or f"Call {call['id']}"), call=call, audio_src=f"ext://call.audio?id={call['id']}", offset=0, tab=tab)
+        await fragments.set(key, html)
+    return html
 
+async def getCall(call_id, next=False, prev=False):
+    query = "select * from Call where id = ?"
     if next:
-        msg["data"]["sql"] = f"select * from Call where id > '{call_id}' order by id asc limit 1"
+        query = "select * from Call where id > ? order by id asc limit 1"
     elif prev:
-        msg["data"]["sql"] = f"select * from Call where id < '{call_id}' order by id desc limit 1"
+        query = "select * from Call where id < ? order by id desc limit 1"
 
     remynd.log(f"Sending sql request for call {call_id}...")
-    response = await message_center.send_message(msg)
-    result = response.get('result')
+    # participants is stored as a JSON string
+    result = await remynd.sql(message_center, query, (int(call_id),), db="extras", json_columns=('participants',))
 
     if not result:
         return
     
-    call = result[0]
+    return result[0]
 
-    # workaround to expand json strings
-    if type(call['participants']) is str:
-        call['participants'] = json.loads(call['participants'])
-        
+# Cached data of a call is keyed by its version, bumping it invalidates all of it
+async def callVersion(call_id):
+    return await kvstore.get_int(f"call_version:{call_id}")
+
+async def invalidateCall(call_id):
+    await kvstore.increment(f"call_version:{call_id}")
+
+async def getCachedCall(call_id):
+    key = f"call:{call_id}:{await callVersion(call_id)}"
+    cached = await fragments.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    call = await getCall(call_id)
+    # a call in progress gets its endDate later, only finished calls are cached
+    if call is not None and call.get('endDate'):
+        await fragments.set(key, json.dumps(call))
+    return call
+
+# Next or previous call in id order. Call ids only grow, so a neighbour once found stays
+# the same and is cached.
+async def getAdjacentCall(call_id, next=False, prev=False):
+    key = f"{'next' if next else 'prev'}:{call_id}"
+    adjacent_id = await fragments.get(key)
+    if adjacent_id is not None:
+        return await getCachedCall(int(adjacent_id))
+
+    call = await getCall(call_id, next=next, prev=prev)
+    if call is not None:
+        await fragments.set(key, str(call['id']))
+        # and call_id is the neighbour on the other side of the call found
+        await fragments.set(f"{'prev' if next else 'next'}:{call['id']}", str(call_id))
+        if call.get('endDate'):
+            await fragments.set(f"call:{call['id']}:{await callVersion(call['id'])}", json.dumps(call))
     return call
 
+prefetch_task = None
+
+# Loads and renders the calls before and after call_id into the cache in the background,
+# so that nextItem/previousItem show them without waiting for SQL
+def prefetchAdjacent(call_id):
+    global prefetch_task
+    if prefetch_task and not prefetch_task.done():
+        prefetch_task.cancel()
+    prefetch_task = loop.create_task(prefetchCalls(call_id))
+
+async def prefetchCalls(call_id):
+    try:
+        tab = await kvstore.get('tab')
+        for step in ({'next': True}, {'prev': True}):
+            call = await getAdjacentCall(call_id, **step)
+            if not call or not call.get('endDate'):
+                continue
+            await renderCallWindow(call, tab)
+            await renderTranscription(call)
+            await renderSummary(call)
+            remynd.log("Prefetched call", call['id'], level='debug')
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        remynd.log(f"Prefetch for call {call_id} failed: {e}", level='warning')
+
 async def getCallSummary(call_id):
     msg = {
         "event": "edb.runEdgeQL",
@@ -336,36 +392,52 @@ async def getCallSummary(call_id):
         'createdAt': summary_created_at
     }
 
+# Participant -> call ids index, one sorted set per person scored by call id. Calls are added
+# on callDidStart/callDidEnd, calls recorded while the extension wasn't running are picked up
+# by indexCalls at startup. 'participants_indexed' is the last call id indexed from the table.
+async def indexCall(call_id, participants):
+    await asyncio.gather(*(kvstore.add_sorted(f"participant:{p}", {call_id: call_id}) for p in participants or []))
+
+# Never raises, getCallList awaits its task on every person window.
+async def indexCalls(page_size=100):
+    last_id = 0
+    count = 0
+
+    try:
+        last_id = await kvstore.get_int('participants_indexed')
+        while True:
+            result = await remynd.sql(message_center,
+                "select id, participants from Call where id > ? order by id limit ?",
+                (last_id, page_size), db="extras", json_columns=('participants',))
+
+            await asyncio.gather(*(indexCall(c['id'], c['participants']) for c in result))
+            count += len(result)
+
+            if result:
+                last_id = result[-1]['id']
+                await kvstore.set_int('participants_indexed', last_id)
+            if len(result) < page_size:
+                break
+    except Exception as e:
+        # person windows miss the calls not indexed yet, the next start continues from last_id
+        remynd.log(f"Failed indexing participants after call {last_id}: {e}", level='warning')
+        return
+
+    remynd.log(f"Indexed participants of {count} calls")
+
+# Calls of a participant, newest first. The rows are fetched by id, 100 at a time (the app's
+# row limit), with the ids passed as one JSON array so the query text stays the same.
 async def getCallList(participant):
+    await participants_indexed
+    call_ids = [int(i) for i in await kvstore.range_sorted(f"participant:{participant}", reverse=True)]
     calls = []
-    count = 1
-    last_id = sys.maxsize
-    participant = participant.replace("'", "''")
-
-    while True:
-        msg = {
-            "event": "sql.runSQL",
-            "data": {
-                "sql": f"select * from Call where participants like '%{participant}%' and id < {last_id} order by id desc",
-                "db": "extras"
-            }
-        }
-        remynd.log(f"Sending sql request for calls {count}...")
-        response = await message_center.send_message(msg)
-        result = response.get('result')
-        count += 1
 
-        if not result:
-            break
-    
-        calls += result
-        last_id = result[-1]['id']
+    for i in range(0, len(call_ids), 100):
+        remynd.log(f"Sending sql request for calls {i // 100 + 1}...")
+        calls += await remynd.sql(message_center,
+            "select * from Call where id in (select value from json_each(?)) order by id desc",
+            (json.dumps(call_ids[i:i + 100]),), db="extras", json_columns=('participants',))
 
-    # workaround to expand json strings
-    for c in calls:
-        if type(c['participants']) is str:
-            c['participants'] = json.loads(c['participants'])
-        
     return calls
 
 async def showPersonWindow(name, no_push=False):
@@ -381,8 +453,7 @@ async def showPersonWindow(name, no_push=False):
     else:
         person['initials'] = name[0].upper()
 
-    template = env.get_template("person.html")
-    html = template.render(title=name, person=person)
+    html = await render("person.html", title=name, person=person)
 
     await showWindow(html)
 
@@ -406,26 +477,13 @@ async def pushEntity():
     if not entity:
         return
 
-    history = await kvstore.get_json('history') or []
-
-    if history and history[-1] == entity:
+    if await kvstore.range_json('history', -1) == [entity]:
         return
     
-    history.append(entity)
-    await kvstore.set_json('history', history)
+    await kvstore.append_json('history', entity, maxlen=100)
 
 async def popEntity():
-    history = await kvstore.get_json('history')
-
-    if not history:
-        return
-    
-    entity = history.pop()
-    if history:
-        await kvstore.set_json('history', history)
-    else:
-        await kvstore.remove('history')
-    return entity
+    return await kvstore.pop_tail_json('history')
 
 async def showEntity(entity, no_push=False):
     e_type, e_id = entity.split(':', 1)
@@ -478,6 +536,7 @@ async def setCallTitle(call_id, title):
     }
     view_resp = await message_center.send_message(seek_msg)
     remynd.log("Title update:", view_resp)
+    await invalidateCall(call_id)
 
 async def shareCall(call_id):
     seek_msg = {
@@ -499,10 +558,11 @@ async def handleJSCallback(msg):
     if loaded:
         if loaded == await kvstore.get('entity') and loaded.startswith("call:"):
             call_id = int(loaded.split(":")[-1])
-            call = await getCall(call_id)
+            call = await getCachedCall(call_id)
             await injectTranscription(call)
             await injectSummary(call=call)
             remynd.log("Call loaded:", call_id)
+            prefetchAdjacent(call_id)
         return
 
     timestamp = msg.get('timeUpdate')
@@ -595,6 +655,7 @@ async def createSummary(call_id):
     }
     summary_resp = await message_center.send_message(save_msg)
     remynd.log(summary_resp)
+    await invalidateCall(call_id)
 
     if await injectSummary(call_id=call_id):
         # return
@@ -615,18 +676,12 @@ async def createSummary(call_id):
     remynd.log("Notification id:", response)
 
 async def injectSummary(call=None, call_id=None):
-    template = env.get_template("summary.html")
     if call is None:
-        call = await getCall(call_id)
+        call = await getCachedCall(call_id)
     else:
         call_id = call['id']
 
-    # TODO: prepare summary instead of making query
-    summary_data = await getCallSummary(call_id)
-    if summary_data:
-        call['summary'] = summary_data['summary']
-        # call['summaryCreatedAt'] = summary_data['createdAt']
-    html = template.render(call=call).replace('`', '\`')
+    html = (await renderSummary(call)).replace('`', '\`')
 
     if await kvstore.get('entity') != f"call:{call_id}":
         return False
@@ -643,21 +698,80 @@ async def injectSummary(call=None, call_id=None):
 
     return True
 
+async def renderSummary(call):
+    call_id = call['id']
+    key = f"summary:{call_id}:{await callVersion(call_id)}"
+    html = await fragments.get(key)
+    if html is None:
+        # TODO: prepare summary instead of making query
+        summary_data = await getCallSummary(call_id)
+        if summary_data:
+            call = dict(call, summary=summary_data['summary'])
+            # call['summaryCreatedAt'] = summary_data['createdAt']
+        html = await render("summary.html", call=call)
+        await fragments.set(key, html)
+    return html
+
+# Whole transcription of a finished call, cached
+async def renderTranscription(call):
+    call_id = call['id']
+    key = f"transcription:{call_id}:{await callVersion(call_id)}"
+    html = await fragments.get(key)
+    if html is None:
+        pages = [await render("transcription.html", call=dict(call, transcription=page)) async for page in iterTranscription(call_id)]
+        # renders the 'not generated' message
+        html = ''.join(pages) or await render("transcription.html", call=dict(call, transcription=[]))
+        await fragments.set(key, html)
+    return html
+
+# Renders the transcription into the call window page by page as it is loaded, the first
+# page replaces the placeholder and the next ones are appended. Finished calls are cached.
 async def injectTranscription(call):
-    template = env.get_template("transcription.html")
     # call = await getCall(call_id)
     call_id = call['id']
-    call['transcription'] = await getTranscription(call_id)
-    html = template.render(call=call).replace('`', '\`')
+    key = None
+    # the transcription of a call in progress still grows
+    if call.get('endDate'):
+        key = f"transcription:{call_id}:{await callVersion(call_id)}"
+        html = await fragments.get(key)
+        if html is not None:
+            return await appendTranscription(call_id, html, replace=True)
+
+    pages = []
+    async for page in iterTranscription(call_id):
+        html = await render("transcription.html", call=dict(call, transcription=page))
+        if not await appendTranscription(call_id, html, replace=not pages):
+            return False
+        pages.append(html)
+
+    if not pages:
+        # renders the 'not generated' message
+        html = await render("transcription.html", call=dict(call, transcription=[]))
+        if not await appendTranscription(call_id, html, replace=True):
+            return False
+        pages.append(html)
+
+    if key:
+        await fragments.set(key, ''.join(pages))
+    return True
+
+async def appendTranscription(call_id, html, replace=False):
+    html = html.replace('`', '\`')
 
     if await kvstore.get('entity') != f"call:{call_id}":
         return False
 
     remynd.log("Inject transcription for call", call_id)
 
+    if replace:
+        update = f"items.innerHTML = `{html}`;"
+    else:
+        update = f"items.insertAdjacentHTML('beforeend', `{html}`);"
+
     await evaluateJavaScript(f"""
         (() => {{ 
-            document.querySelector(".transcript-items").innerHTML = `{html}`;
+            const items = document.querySelector(".transcript-items");
+            {update}
             updateTranscript();
             onTimeUpdate(null);
         }})();
@@ -678,94 +792,79 @@ async def handleNotificationCallback(msg):
         await shareCall(call_id)
         return
 
-# Handler for incoming events on the 'ui' channel
-async def ui_handler(channel, event, msg):
-    if event == 'positionDidChange':
-        await updatePlayerPosition(msg.get('timestamp'))
-        return
+# Handler for 'positionDidChange' events on the 'ui' channel
+async def position_handler(channel, event, msg):
+    await updatePlayerPosition(msg.get('timestamp'))
 
-    remynd.log(f'Unhandled event: {event}:\n', json.dumps(msg, indent=4))
+# Handlers for incoming events on the 'messages' channel
+async def copilot_handler(channel, event, msg):
+    await showCallWindow(msg.get('call'), audio_url=msg.get('source'), offset=msg.get('offset', 0))
 
-#     elif event == 'notificationCallback':
-#         await handleNotificationCallback(msg)
+async def summary_handler(channel, event, msg):
+    await createSummary(msg.get('call')['id'])
 
-# Handler for incoming events on the 'message' channel
-async def msg_handler(channel, event, msg):
-    # print(f"{event}:\n", json.dumps(msg, indent=4))
+async def js_handler(channel, event, msg):
+    await handleJSCallback(msg)
 
-    if event == 'callCopilot':
-        await showCallWindow(msg.get('call'), audio_url=msg.get('source'), offset=msg.get('offset', 0))
-        return
+async def notification_handler(channel, event, msg):
+    await handleNotificationCallback(msg)
 
-    if event == 'callSummary':
-        await createSummary(msg.get('call')['id'])
-        return
+async def back_handler(channel, event, msg):
+    entity = await popEntity()
+    if entity:
+        await showEntity(entity, no_push=True)
 
-    if event == 'jsEventFired':
-        await handleJSCallback(msg)
-        return
-    
-    if event == 'notificationCallback':
-        await handleNotificationCallback(msg)
+# 'nextItem' and 'previousItem' step through calls ordered by id
+async def step_handler(channel, event, msg):
+    entity = await kvstore.get('entity')
+    if not entity:
         return
+    if entity.startswith("call:"):
+        call_id = int(entity.split(':')[-1])
+        call = await getAdjacentCall(call_id, next=(event == 'nextItem'), prev=(event == 'previousItem'))
+        if call:
+            tab = await kvstore.get('tab')
+            await showCallWindow(call, tab=tab, jump_to=True)
 
-    if event == 'goBack':
-        entity = await popEntity()
-        if entity:
-            await showEntity(entity, no_push=True)
-        return
-    
-    if event == 'nextItem':
-        entity = await kvstore.get('entity')
-        if not entity:
-            return
-        if entity.startswith("call:"):
-            call_id = int(entity.split(':')[-1])
-            call = await getCall(call_id, next=True)
-            if call:
-                tab = await kvstore.get('tab')
-                await showCallWindow(call, tab=tab, jump_to=True)
-        return
-    
-    if event == 'previousItem':
-        entity = await kvstore.get('entity')
-        if not entity:
-            return
-        if entity.startswith("call:"):
-            call_id = int(entity.split(':')[-1])
-            call = await getCall(call_id, prev=True)
-            if call:
-                tab = await kvstore.get('tab')
-                await showCallWindow(call, tab=tab, jump_to=True)
-        return
-    
-    # if event == 'settings':
-    #     await showSettings()
-    #     return
-
-    if event == 'windowWillClose':
-        if msg['windowID'] == await kvstore.get_int('window_id'):
-            await kvstore.remove('window_id')
-            await kvstore.remove('entity')
-            await kvstore.remove('history')
-        return
+async def close_handler(channel, event, msg):
+    if msg['windowID'] == await kvstore.get_int('window_id'):
+        await kvstore.remove('window_id')
+        await kvstore.remove('entity')
+        await kvstore.remove('history')
 
-# Handler for incoming events on the 'call' channel
+# Handlers for incoming events on the 'calls' channel
 async def call_handler(channel, event, msg):
-    remynd.log(f"{event}:\n", json.dumps(msg, indent=4))
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
 
-    if event == 'callDidStart':
-        await kvstore.set_int('max_call_id', msg['id'])
+async def call_start_handler(channel, event, msg):
+    await kvstore.set_int('max_call_id', msg['id'])
+    await indexCall(msg['id'], msg.get('participants'))
 
-    if event == 'callDidEnd':
-        await createSummary(msg['id'])
+async def call_end_handler(channel, event, msg):
+    # participants who joined later are only in the final list
+    await indexCall(msg['id'], msg.get('participants'))
+    # the call now has an end date and a complete transcription
+    await invalidateCall(msg['id'])
+    await createSummary(msg['id'])
 
 loop.create_task(register())
 loop.create_task(set_locale())
 loop.create_task(getCallEdgeIds())
-message_center.subscribe('ui', ui_handler)
-message_center.subscribe('messages', msg_handler)
+participants_indexed = loop.create_task(indexCalls())
+message_center.subscribe('ui', 'positionDidChange', position_handler)
+# only the latest player position matters
+message_center.limit('ui', policy='coalesce')
+message_center.subscribe('messages', 'callCopilot', copilot_handler)
+message_center.subscribe('messages', 'callSummary', summary_handler)
+message_center.subscribe('messages', 'jsEventFired', js_handler)
+message_center.subscribe('messages', 'notificationCallback', notification_handler)
+message_center.subscribe('messages', 'goBack', back_handler)
+message_center.subscribe('messages', 'nextItem', step_handler)
+message_center.subscribe('messages', 'previousItem', step_handler)
+message_center.subscribe('messages', 'windowWillClose', close_handler)
 message_center.subscribe('calls', call_handler)
+message_center.subscribe('calls', 'callDidStart', call_start_handler)
+message_center.subscribe('calls', 'callDidEnd', call_end_handler)
 
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
@@ -47,15 +47,13 @@ async def handleDidCaptureFrame(msg):
     frame_count = await kvstore.increment('frame_count')
     print('Frame count:', frame_count)
 
-    frame_timestamps = await kvstore.get_json('frame_timestamps')    
-    frame_timestamps = frame_timestamps or []
-    frame_timestamps.append(int(msg['timestamp']))
-    await kvstore.set_json('frame_timestamps', frame_timestamps)
+    await kvstore.append_json('frame_timestamps', int(msg['timestamp']), maxlen=100)
 
     if frame_count < 10:
         return
     
     await kvstore.remove('frame_count')
+    frame_timestamps = await kvstore.range_json('frame_timestamps')
     remynd.log("Trigger UI notification...")
     
     msg = {
@@ -70,17 +68,17 @@ async def handleDidCaptureFrame(msg):
     response = await message_center.send_message(msg)
     print("Notification id: ", response)
 
-# Handler for incoming events on the 'ui' channel
-async def ui_handler(channel, event, msg):
-    if event == 'notificationCallback':
-        await handleNotificationCallback(msg)
+# Handler for 'notificationCallback' events on the 'ui' channel
+async def notification_handler(channel, event, msg):
+    await handleNotificationCallback(msg)
 
-# Handler for incoming events on the 'recorder' channel
-async def recorder_handler(channel, event, msg):
-    if event == 'didCaptureFrame':
-        await handleDidCaptureFrame(msg)
+# Handler for 'didCaptureFrame' events on the 'recorder' channel
+async def frame_handler(channel, event, msg):
+    await handleDidCaptureFrame(msg)
 
-message_center.subscribe('ui', ui_handler)
-message_center.subscribe('recorder', recorder_handler)
+message_center.subscribe('ui', 'notificationCallback', notification_handler)
+message_center.subscribe('recorder', 'didCaptureFrame', frame_handler)
+# count every frame, one at a time
+message_center.limit('recorder', policy='block')
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
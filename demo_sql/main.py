@@ -206,6 +206,15 @@ async def updateWindow(window_id, result=''):
     remynd.log("Failed to execute js in window: ", window_id, view_resp)
     return False
 
+# Pretty-prints a query result, large results take a while: run it with remynd.run_blocking
+def format_result(result):
+    json_text = json.dumps(result, indent=4)
+    # workaround to decode \uXXXX uncicode symbols
+    codepoint = re.compile(r'(\\u[0-9a-fA-F]{4})')
+    def replace(match):
+        return chr(int(match.group(1)[2:], 16))
+    return codepoint.sub(replace, json_text)
+
 async def handleJSCallback(msg):
     print('Execute:', msg)
     query = msg.get('query')
@@ -227,24 +236,18 @@ async def handleJSCallback(msg):
 
     if result is None:
         print("Response: ", response)
-        json_text = json.dumps(response, indent=4)
+        json_text = await remynd.run_blocking(json.dumps, response, indent=4)
     
     else:
-        json_text = json.dumps(result, indent=4)
-        # workaround to decode \uXXXX uncicode symbols
-        codepoint = re.compile(r'(\\u[0-9a-fA-F]{4})')
-        def replace(match):
-            return chr(int(match.group(1)[2:], 16))
-        json_text = codepoint.sub(replace, json_text)
+        json_text = await remynd.run_blocking(format_result, result)
 
     await showWindow(query, db=db, result=json_text)
 
-# Handler for incoming events on the 'messages' channel
-async def msg_handler(channel, event, msg):
-    if event == 'jsEventFired':
-        await handleJSCallback(msg)
+# Handler for 'jsEventFired' events on the 'messages' channel
+async def js_handler(channel, event, msg):
+    await handleJSCallback(msg)
 
 loop.create_task(showWindow('SELECT * FROM FrameOCR LIMIT 10;'))
-message_center.subscribe('messages', msg_handler)
+message_center.subscribe('messages', 'jsEventFired', js_handler)
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
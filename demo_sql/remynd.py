@@ -2,94 +2,1109 @@ import redis.asyncio as redis
 import asyncio
 import json
 import uuid
-from fnmatch import fnmatch
+import time
+import random
+import re
+import traceback
+import functools
+from collections import deque, OrderedDict
+from fnmatch import translate
 from datetime import datetime
 import os
+import sys
+import queue
+import atexit
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# JSON codec used for every message and Dictionary value. orjson or msgspec are used when
+# they are packaged with the extension, the standard library otherwise. REMYND_CODEC
+# (orjson/msgspec/json) or use_codec() pick one explicitly.
+def use_codec(name=None):
+    global codec, dumps, loads
+    if name in (None, 'orjson') and orjson:
+        codec = 'orjson'
+        dumps = functools.partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS)
+        loads = orjson.loads
+    elif name in (None, 'msgspec') and msgspec:
+        codec = 'msgspec'
+        dumps = msgspec.json.Encoder().encode
+        loads = msgspec.json.Decoder().decode
+    elif name in (None, 'json'):
+        codec = 'json'
+        dumps = json.dumps
+        loads = json.loads
+    else:
+        raise ValueError(f"JSON codec not available: {name}")
+
+use_codec(os.environ.get('REMYND_CODEC'))
+
+# Routing fields of an inbound message. With msgspec the 'data' body is kept as raw JSON
+# and only decoded when the message reaches a handler or a pending request.
+if msgspec:
+    class Envelope(msgspec.Struct):
+        extensionID: object = None
+        origin: object = None
+        responseID: object = None
+        event: object = None
+        data: msgspec.Raw = msgspec.Raw(b'{}')
+
+    peek = msgspec.json.Decoder(Envelope).decode
+else:
+    peek = None
+
+# Without msgspec, the extensionID of a response is read from the raw JSON to recognize
+# responses meant for other extensions before decoding them
+_extension_id = re.compile(r'"extensionID"\s*:\s*"([^"\\]{0,200})"').match
+
+# Errors raised by the codecs for malformed messages
+DECODE_ERRORS = (ValueError, msgspec.DecodeError) if msgspec else (ValueError,)
+
+def _body(data):
+    if msgspec and isinstance(data, msgspec.Raw):
+        return loads(bytes(data))
+    return data
+
+# Settings of the Redis connection pool shared by every MessageCenter and Dictionary in the
+# process. Change them with configure() before the first connection is made.
+pool_options = {
+    'max_connections': 32,
+    # seconds to wait for a free connection when all of them are busy
+    'timeout': 20,
+    'health_check_interval': 30,
+    'socket_keepalive': True,
+    'socket_connect_timeout': 5,
+    # pubsub and stream readers block for a long time, they must not time out
+    'socket_timeout': None,
+}
+_client = None
+
+def configure(**options):
+    global _client
+    pool_options.update(options)
+    _client = None
+
+# Returns the shared Redis client, creating it on first use (after the event loop exists).
+# REDIS_PORT is a TCP port on localhost or the path of a unix socket.
+def connection():
+    global _client
+    if _client is None:
+        port = str(os.environ.get('REDIS_PORT', 6381))
+        options = dict(pool_options, decode_responses=True)
+        if port.isdigit():
+            pool = redis.BlockingConnectionPool(host='localhost', port=int(port), **options)
+        else:
+            options.pop('socket_keepalive', None)
+            pool = redis.BlockingConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=port, **options)
+        _client = redis.Redis(connection_pool=pool)
+    return _client
+
+# Raised when the app does not answer a send_message request in time
+class RequestTimeout(TimeoutError):
+    pass
+
+# Raised for requests in flight when the connection to Redis was lost. The response can't
+# arrive anymore, sending the request again is safe.
+class ConnectionLost(ConnectionError):
+    pass
+
+# Raised by sql() when the app reports an error for a query
+class SQLError(Exception):
+    pass
+
+# Thread pool for blocking work (file reads, template renders, large dumps), created on first use
+blocking_workers = 4
+_executor = None
+
+# Runs fn(*args, **kwargs) in the thread pool so the event loop keeps dispatching meanwhile
+async def run_blocking(fn, *args, **kwargs):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix='remynd-blocking')
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+# Reports callbacks that keep the event loop busy for longer than threshold seconds. A task
+# stamps a heartbeat; a thread notices when it stops and logs the loop thread's stack, the
+# task logs how long the loop was gone once it is back. In asyncio debug mode
+# (PYTHONASYNCIODEBUG=1) asyncio's own slow callback warnings use the same threshold and are
+# sent to the remynd log.
+class LoopWatchdog:
+    def __init__(self, loop, threshold=0.1, metrics=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.metrics = metrics
+        self.beat = time.monotonic()
+        self.blocked = 0
+        self.thread_id = None
+        self.task = None
+
+    # Must be called from the loop's thread
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.task = self.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='remynd-watchdog', daemon=True).start()
+        if self.loop.get_debug():
+            self.loop.slow_callback_duration = self.threshold
+            asyncio_logger = logging.getLogger('asyncio')
+            if not any(isinstance(h, _LogHandler) for h in asyncio_logger.handlers):
+                asyncio_logger.addHandler(_LogHandler())
+                asyncio_logger.propagate = False
+
+    async def _heartbeat(self):
+        interval = self.threshold / 2
+        while True:
+            started = self.beat = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = time.monotonic() - started - interval
+            if lag > self.threshold:
+                self.blocked += 1
+                if self.metrics:
+                    self.metrics.observe('loop.blocked', lag)
+                log(f"Event loop blocked for {lag * 1000:.0f}ms", level='warning')
+
+    def _watch(self):
+        reported = None
+        while not self.task.done():
+            time.sleep(self.threshold / 2)
+            beat = self.beat
+            if beat != reported and time.monotonic() - beat > self.threshold:
+                reported = beat
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    log("Event loop blocked in:\n", lazy(lambda: ''.join(traceback.format_stack(frame))), level='warning')
+
+# Forwards records of the standard logging module to log()
+class _LogHandler(logging.Handler):
+    def emit(self, record):
+        level = record.levelname.lower()
+        log(record.getMessage(), level=level if level in LEVELS else 'error')
+
+# Maps channels and optional event names to handlers. Literal channels are a dict lookup,
+# fnmatch-style globs are compiled once, and the tables matching a channel are memoized.
+class Router:
+    def __init__(self):
+        # channel -> {event: [handlers]}, the None event receives every event
+        self.literal = {}
+        # [(pattern, regex, {event: [handlers]})]
+        self.globs = []
+        self.resolved = {}
+
+    def add(self, channel, handler, event=None):
+        if any(c in channel for c in '*?['):
+            table = next((t for pattern, _, t in self.globs if pattern == channel), None)
+            if table is None:
+                table = {}
+                self.globs.append((channel, re.compile(translate(channel)), table))
+        else:
+            table = self.literal.setdefault(channel, {})
+        table.setdefault(event, []).append(handler)
+        self.resolved.clear()
+
+    @property
+    def channels(self):
+        return list(self.literal)
+
+    @property
+    def patterns(self):
+        return [pattern for pattern, _, _ in self.globs]
+
+    def match(self, channel, event):
+        tables = self.resolved.get(channel)
+        if tables is None:
+            tables = [self.literal[channel]] if channel in self.literal else []
+            tables += [table for _, regex, table in self.globs if regex.match(channel)]
+            self.resolved[channel] = tables
+
+        handlers = []
+        for table in tables:
+            handlers += table.get(event, ())
+            handlers += table.get(None, ())
+        return handlers
+
+# Bounded queue of messages for one channel, served by at most `concurrency` workers.
+# When the queue is full, policy decides what happens to a new message:
+#   drop_oldest - the oldest queued message is discarded
+#   coalesce    - a queued message with the same event is replaced, otherwise drop_oldest
+#   block       - nothing is dropped, the message waits in held until there is room. Only this
+#                 lane's channel is held back: the streams reader stops reading its stream while
+#                 the lane is full, the pubsub reader keeps the waiting messages in memory (pub/sub
+#                 can't slow the publisher). Responses and other channels are read as usual, so a
+#                 handler can await send_message while its lane is full.
+# An item's done future (streams transport) is resolved once its handlers ran or it was dropped.
+class Lane:
+    policies = ('drop_oldest', 'coalesce', 'block')
+
+    def __init__(self, center, concurrency=1, maxsize=100, policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown lane policy: {policy}")
+        self.center = center
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.workers = 0
+        self.dropped = 0
+        # Messages waiting for room in the queue (block)
+        self.held = deque()
+        # Resolved when the queue has room again
+        self.space = None
+
+    def put(self, item):
+        if self.policy == 'coalesce':
+            for i, queued in enumerate(self.items):
+                if queued[1] == item[1]:
+                    self.items[i] = item
+                    self.dropped += 1
+                    _settle(queued[4])
+                    return
+        if self.held or len(self.items) >= self.maxsize:
+            if self.policy == 'block':
+                self.held.append(item)
+                return
+            _settle(self.items.popleft()[4])
+            self.dropped += 1
+        self.items.append(item)
+        if self.workers < self.concurrency:
+            self.workers += 1
+            self.center._spawn(self._work())
+
+    # Resolves once the lane takes messages again
+    def wait_for_space(self):
+        if self.space is None or self.space.done():
+            self.space = self.center.loop.create_future()
+            if not self.held:
+                self.space.set_result(None)
+        return self.space
+
+    async def _work(self):
+        try:
+            while self.items:
+                channel, event, data, handlers, done = self.items.popleft()
+                if self.held:
+                    self.items.append(self.held.popleft())
+                if not self.held:
+                    _settle(self.space)
+                try:
+                    for handler in handlers:
+                        await self.center._call(handler, channel, event, data)
+                finally:
+                    _settle(done)
+        finally:
+            self.workers -= 1
+
+def _settle(future):
+    if future is not None and not future.done():
+        future.set_result(None)
+
+# HDR-style latency histogram: values in microseconds, exact below 32us, then 16 buckets per
+# power of two (at most ~6% error). Memory is bounded by the value range, not the sample count.
+class Histogram:
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        if value < 32:
+            index = value
+        else:
+            shift = value.bit_length() - 5
+            index = 32 + (shift - 1) * 16 + (value >> shift) - 16
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @staticmethod
+    def _value(index):
+        if index < 32:
+            return index
+        shift = (index - 32) // 16 + 1
+        low = ((index - 32) % 16 + 16) << shift
+        return low + (1 << shift) // 2
+
+    # Value below which p percent of the samples fall, in microseconds
+    def percentile(self, p):
+        rank = self.count * p / 100
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._value(index), self.max)
+        return 0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count) if self.count else 0,
+            "p50_us": self.percentile(50),
+            "p90_us": self.percentile(90),
+            "p99_us": self.percentile(99),
+            "max_us": self.max,
+        }
+
+# Counters, gauges (callables read at snapshot time) and latency histograms by name
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "gauges": {name: read() for name, read in self.gauges.items()},
+            "latency": {name: h.summary() for name, h in sorted(self.histograms.items())},
+        }
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
 
 class MessageCenter:
-    queue = {}
-    r = redis.Redis(host='localhost', port=os.environ.get('REDIS_PORT', 6381), decode_responses=True)
-    handlers = {}
+    @property
+    def r(self):
+        return connection()
 
-    def __init__(self, loop):
+    # directed: ask the app to reply on messages:<extension_id> instead of the shared
+    # 'messages' channel. The shared channel is left once the app sends a 'directed' event on
+    # the inbox, telling that events for this extension are sent there too.
+    # transport: 'pubsub', or 'streams' to exchange messages through Redis Streams (see _read_streams)
+    # backoff_min/backoff_max: bounds of the reconnect delay in seconds, doubled after every failure
+    # metrics_interval: log a metrics summary every that many seconds
+    # block_threshold: report callbacks blocking the event loop for longer than that many
+    # seconds (see LoopWatchdog), defaults to REMYND_BLOCK_THRESHOLD
+    def __init__(self, loop, push=True, timeout=600, sweep_interval=30, directed=False,
+                 transport='pubsub', stream_maxlen=10000, stream_batch=100, backoff_min=0.1, backoff_max=5,
+                 metrics_interval=None, block_threshold=None):
+        if transport not in ('pubsub', 'streams'):
+            raise ValueError(f"Unknown transport: {transport}")
         self.loop = loop
-        self.extension_id = os.environ.get('EXTENSION_ID', str(uuid.uuid4()))
+        self.push = push
+        self.directed = directed
+        self.transport = transport
+        self.stream_maxlen = stream_maxlen
+        self.stream_batch = stream_batch
+        # stream key -> last read id, None until the consumer groups exist
+        self.stream_ids = None
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        # 'connecting', 'connected' or 'disconnected'
+        self.state = 'connecting'
+        self.reconnects = 0
+        self.decode_errors = 0
+        self.metrics = Metrics()
+        self.metrics.gauge('pending', lambda: self.pending)
+        self.metrics.gauge('running', lambda: self.running)
+        self.metrics.gauge('dropped', lambda: self.dropped)
+        self.metrics.gauge('reconnects', lambda: self.reconnects)
+        self.metrics.gauge('decode_errors', lambda: self.decode_errors)
+        self.metrics_interval = metrics_interval
+        self.metrics_task = None
+        if block_threshold is None:
+            block_threshold = float(os.environ.get('REMYND_BLOCK_THRESHOLD', 0)) or None
+        self.block_threshold = block_threshold
+        self.watchdog = None
+        # Default send_message timeout in seconds (None waits forever)
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.extension_id = hosting or os.environ.get('EXTENSION_ID', str(uuid.uuid4()))
+        self.inbox = f"messages:{self.extension_id}"
+        # True once the app directs events to the inbox, shared tells whether 'messages' is still subscribed
+        self.inbox_ready = False
+        self.shared = False
         self.pubsub = self.r.pubsub()
+        self.router = Router()
+        self.router.add('messages', self._metrics_handler, 'metrics')
+        # channel -> Lane, channels without a lane run every handler in its own task
+        self.lanes = {}
+        self.tasks = set()
+        # (channel, event) -> number of events folded by debounce/throttle
+        self.folded = {}
+        # responseID -> (future, deadline)
+        self.queue = {}
+        self.sweeper = None
+        # While the streams reader triages an entry: what its acknowledgement waits for
+        self.acking = None
+        # (stream key, entry id) of entries whose handlers are still running
+        self.unacked = set()
 
     def run(self):
+        # Extensions loaded by a Host are served by the host's reader
+        if host is not None:
+            host.add(self)
+            return
         self.loop.run_until_complete(self.listen_for_messages())
 
-    def subscribe(self, channel, handler):
-        self.handlers[channel] = handler
+    # subscribe(channel, handler) receives every event on the channel,
+    # subscribe(channel, event, handler) only that event. Channels may be globs ('ui*').
+    def subscribe(self, channel, event, handler=None):
+        if handler is None:
+            event, handler = None, event
+        self.router.add(channel, handler, event)
+
+    # Limits how many handlers run at once for a channel, queueing up to maxsize messages.
+    # See Lane for the available policies.
+    def limit(self, channel, concurrency=1, maxsize=100, policy='drop_oldest'):
+        self.lanes[channel] = Lane(self, concurrency, maxsize, policy)
+
+    # Handler decorator: waits until events stop arriving for `wait` seconds,
+    # then runs once with the latest message. Keyed by channel and event.
+    def debounce(self, wait):
+        def decorator(handler):
+            timers = {}
+
+            def fire(key, channel, event, msg):
+                del timers[key]
+                self._spawn(handler(channel, event, msg))
+
+            @functools.wraps(handler)
+            async def wrapper(channel, event, msg):
+                key = (channel, event)
+                if key in timers:
+                    timers[key].cancel()
+                    self._fold(key)
+                timers[key] = self.loop.call_later(wait, fire, key, channel, event, msg)
+            return wrapper
+        return decorator
+
+    # Handler decorator: runs at most once per `interval` seconds. The first event runs
+    # right away, later ones in the window fold into a single run with the latest message.
+    def throttle(self, interval):
+        def decorator(handler):
+            last_run = {}
+            pending = {}
+
+            def fire(key, channel, event):
+                last_run[key] = self.loop.time()
+                self._spawn(handler(channel, event, pending.pop(key)))
+
+            @functools.wraps(handler)
+            async def wrapper(channel, event, msg):
+                key = (channel, event)
+                if key in pending:
+                    pending[key] = msg
+                    self._fold(key)
+                    return
+                delay = last_run.get(key, float('-inf')) + interval - self.loop.time()
+                if delay <= 0:
+                    last_run[key] = self.loop.time()
+                    await handler(channel, event, msg)
+                    return
+                pending[key] = msg
+                self.loop.call_later(delay, fire, key, channel, event)
+            return wrapper
+        return decorator
+
+    def _fold(self, key):
+        self.folded[key] = self.folded.get(key, 0) + 1
+
+    # Number of handler tasks currently running
+    @property
+    def running(self):
+        return len(self.tasks)
+
+    # Number of messages discarded by full or coalescing lanes
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self.lanes.values())
+
+    # Runs a coroutine as a tracked task, so it can't be garbage-collected mid-flight
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
 
-    async def send_message(self, msg):
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            self._report(task.get_coro(), task.exception())
+
+    # Runs one handler call, timing it per channel and event
+    async def _call(self, handler, channel, event, data):
+        started = time.perf_counter()
+        try:
+            await handler(channel, event, data)
+        except Exception as e:
+            self.metrics.count('handler.errors')
+            self._report(handler, e)
+        finally:
+            self.metrics.observe(f"handler.{channel}.{event}", time.perf_counter() - started)
+
+    def _report(self, source, e):
+        name = getattr(source, '__qualname__', source)
+        log(f"Event handler error raised in {name}:\n", ''.join(traceback.format_exception(e)), level='error')
+
+    # Number of send_message requests still waiting for a response
+    @property
+    def pending(self):
+        return len(self.queue)
+
+    # Stamps routing fields on an outgoing request and parks a future for its response
+    def _expect_response(self, msg, timeout):
         responseID = str(uuid.uuid4())
         msg["responseID"] = responseID
         msg["extensionID"] = self.extension_id
         msg["origin"] = "extension"
+        if self.directed:
+            msg["replyChannel"] = self.inbox
+
+        resp_future = self.loop.create_future()
+        self.queue[responseID] = (resp_future, time.monotonic() + timeout if timeout else None)
+        return responseID, resp_future
+
+    async def _wait_response(self, msg, resp_future, timeout, started):
+        event = msg.get('event')
+        try:
+            response = await asyncio.wait_for(resp_future, timeout)
+        except asyncio.TimeoutError:
+            self.metrics.count(f"request.timeouts.{event}")
+            raise RequestTimeout(f"No response to {event} after {timeout}s") from None
+        self.metrics.observe(f"request.{event}", time.perf_counter() - started)
+        return response
+
+    async def send_message(self, msg, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        responseID, resp_future = self._expect_response(msg, timeout)
+        try:
+            if self.transport == 'streams':
+                await self._join_streams()
+            started = time.perf_counter()
+            await self._publish(self.r, "messages", dumps(msg))
+            return await self._wait_response(msg, resp_future, timeout, started)
+        finally:
+            # Also runs when the caller is cancelled, so the entry never leaks
+            self.queue.pop(responseID, None)
+
+    # Publishes independent requests through one pipeline and waits for all responses.
+    # With a limit, at most `limit` requests are in flight at a time: each response frees a
+    # slot for the next request, so one slow request doesn't hold back the others.
+    async def send_many(self, msgs, timeout=None, limit=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not msgs:
+            return []
+        if not limit or limit >= len(msgs):
+            return await self._send_batch(msgs, timeout)
+
+        semaphore = asyncio.Semaphore(limit)
+
+        async def send(msg):
+            async with semaphore:
+                return await self.send_message(msg, timeout)
+
+        tasks = [self.loop.create_task(send(msg)) for msg in msgs]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # One failed or the caller was cancelled, the rest is not waited for
+            for task in tasks:
+                task.cancel()
+
+    async def _send_batch(self, msgs, timeout):
+        expected = [self._expect_response(msg, timeout) for msg in msgs]
+        try:
+            if self.transport == 'streams':
+                await self._join_streams()
+            started = time.perf_counter()
+            async with self.r.pipeline(transaction=False) as pipe:
+                for msg in msgs:
+                    self._publish(pipe, "messages", dumps(msg))
+                await pipe.execute()
+            return await asyncio.gather(*(self._wait_response(msg, fut, timeout, started) for msg, (_, fut) in zip(msgs, expected)))
+        finally:
+            for responseID, fut in expected:
+                self.queue.pop(responseID, None)
+                if not fut.done():
+                    fut.cancel()
 
-        resp_future = asyncio.Future()
-        self.queue[responseID] = resp_future
-        await self.r.publish("messages", json.dumps(msg))
-        result = await resp_future
-        return result
-    
+    # Publishes on a client or pipeline, through the channel or its stream
+    def _publish(self, conn, channel, data):
+        if self.transport == 'streams':
+            return conn.xadd(f"stream:{channel}", {'msg': data}, maxlen=self.stream_maxlen, approximate=True)
+        return conn.publish(channel, data)
+
+    # Answers a 'metrics' message from the app with an 'extension.metrics' message
+    # carrying the snapshot, {"reset": true} starts counting from zero again
+    async def _metrics_handler(self, channel, event, msg):
+        snapshot = self.metrics.snapshot()
+        log("Metrics:", lazy(json.dumps, snapshot))
+        await self._publish(self.r, "messages", dumps({
+            "event": "extension.metrics",
+            "extensionID": self.extension_id,
+            "origin": "extension",
+            "data": snapshot
+        }))
+        if isinstance(msg, dict) and msg.get('reset'):
+            self.metrics.reset()
+
+    async def _log_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            snapshot = self.metrics.snapshot()
+            latency = ', '.join(f"{name} p50={h['p50_us']}us p99={h['p99_us']}us n={h['count']}"
+                                for name, h in snapshot['latency'].items())
+            log("Metrics:", snapshot['gauges'], snapshot['counters'], latency)
+
+    # Safety net: fails requests that outlived their deadline but are still queued
+    async def _sweep_requests(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = time.monotonic()
+            stale = [rid for rid, (fut, deadline) in self.queue.items() if fut.done() or (deadline and deadline < now)]
+            for rid in stale:
+                fut, _ = self.queue.pop(rid)
+                if not fut.done():
+                    fut.set_exception(RequestTimeout(f"Request {rid} expired"))
+            if stale:
+                log(f"Dropped {len(stale)} stale requests, {self.pending} pending")
+
+    # Connects and reads until the connection fails, then reconnects after a jittered,
+    # exponentially growing delay. The delay only resets once a connection stayed up.
     async def listen_for_messages(self):
-        await self.pubsub.subscribe(*self.handlers.keys(), 'messages')
+        if self.sweeper is None:
+            self.sweeper = self.loop.create_task(self._sweep_requests())
+        if self.metrics_interval and self.metrics_task is None:
+            self.metrics_task = self.loop.create_task(self._log_metrics())
+        if self.block_threshold and self.watchdog is None:
+            self.watchdog = LoopWatchdog(self.loop, self.block_threshold, self.metrics)
+            self.watchdog.start()
+        delay = self.backoff_min
         while True:
+            connected_at = time.monotonic()
             try:
-                msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                if msg:
-                    self.triage_msg(msg['channel'], json.loads(msg['data']))
+                self.state = 'connecting'
+                await self._connect()
+                self.state = 'connected'
+                connected_at = time.monotonic()
+                if self.transport == 'streams':
+                    await self._read_streams()
+                elif self.push:
+                    await self._read_messages()
+                else:
+                    await self._poll_messages()
             except asyncio.CancelledError:
                 raise
-            except:
-                log("ReMynd connection closed. Retrying...")
-                await asyncio.sleep(1)
+            except Exception as e:
+                self.state = 'disconnected'
+                self.reconnects += 1
+                if time.monotonic() - connected_at > self.backoff_max:
+                    delay = self.backoff_min
+                # Pub/sub responses sent while disconnected are gone, streams keep them
+                if self.transport == 'pubsub':
+                    self._fail_requests()
+                wait = random.uniform(delay / 2, delay)
+                log(f"ReMynd connection lost ({type(e).__name__}: {e}). Reconnecting in {wait:.2f}s...", level='warning')
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.backoff_max)
+
+    # Subscribes a new pubsub (or joins the streams) for every handler channel
+    async def _connect(self):
+        if self.transport == 'streams':
+            self.stream_ids = None
+            await self._join_streams()
+            return
+        try:
+            await self.pubsub.aclose()
+        except Exception:
+            pass
+        self.pubsub = self.r.pubsub()
+        channels = self._channels()
+        self.shared = 'messages' in channels
+        await self.pubsub.subscribe(*channels)
+        patterns = self._patterns()
+        if patterns:
+            await self.pubsub.psubscribe(*patterns)
+
+    def _fail_requests(self):
+        for responseID, (fut, _) in self.queue.items():
+            if not fut.done():
+                fut.set_exception(ConnectionLost(f"Connection lost before the response to {responseID}"))
+
+    def _channels(self):
+        channels = {*self.router.channels, 'messages'}
+        if self.directed:
+            channels.add(self.inbox)
+            if self.inbox_ready:
+                channels.discard('messages')
+        return channels
+
+    def _patterns(self):
+        return self.router.patterns
+
+    # Joins a consumer group named after the extension on the stream of every channel.
+    # A new group starts at the end of its stream; an existing one resumes where it stopped.
+    async def _join_streams(self):
+        if self.stream_ids is not None:
+            return
+        channels = self._channels()
+        for pattern in self.router.patterns:
+            async for key in self.r.scan_iter(match=f"stream:{pattern}", _type='stream'):
+                channels.add(key[len('stream:'):])
+        for channel in channels:
+            try:
+                await self.r.xgroup_create(f"stream:{channel}", self.extension_id, id='$', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        if self.stream_ids is None:
+            self.shared = 'messages' in channels
+            # '0' first delivers entries read but never acknowledged before a restart
+            self.stream_ids = {f"stream:{channel}": '0' for channel in channels}
+
+    # Streams reader: blocks on every channel stream at once and dispatches the batch. An entry
+    # is acknowledged once its handlers have run (also when they failed), entries without
+    # handlers together in one pipeline. Unacknowledged entries are delivered again after a
+    # reconnect or restart, so delivery is at-least-once. The stream of a full blocking lane
+    # is not read until the lane has room.
+    async def _read_streams(self):
+        for key in self.stream_ids:
+            self.stream_ids[key] = '0'
+        while True:
+            full = {f"stream:{channel}": lane for channel, lane in self.lanes.items() if lane.held}
+            ids = {key: entry_id for key, entry_id in self.stream_ids.items() if key not in full}
+            if not ids:
+                await asyncio.wait([lane.wait_for_space() for lane in full.values()], return_when=asyncio.FIRST_COMPLETED)
+                continue
+            # While a lane is full, come back soon to read its stream again
+            batch = await self.r.xreadgroup(self.extension_id, self.extension_id, ids,
+                                            count=self.stream_batch, block=100 if full else 5000)
+            acks = {}
+            for key, entries in batch or []:
+                replay = self.stream_ids.get(key, '>') != '>'
+                if replay:
+                    # Replaying entries left from before: continue after the last one, switch
+                    # to new entries once nothing is left
+                    self.stream_ids[key] = entries[-1][0] if entries else '>'
+                channel = key[len('stream:'):]
+                for entry_id, fields in entries:
+                    if replay and (key, entry_id) in self.unacked:
+                        # Its handlers are still running since before the reconnect
+                        continue
+                    waits = []
+                    if fields:
+                        self.acking = waits
+                        try:
+                            self.triage_raw(channel, fields.get('msg', ''))
+                        finally:
+                            self.acking = None
+                    if waits:
+                        self.unacked.add((key, entry_id))
+                        self._spawn(self._ack_after(key, entry_id, waits))
+                    else:
+                        acks.setdefault(key, []).append(entry_id)
+            if acks:
+                async with self.r.pipeline(transaction=False) as pipe:
+                    for key, ids in acks.items():
+                        pipe.xack(key, self.extension_id, *ids)
+                    await pipe.execute()
+            if self.inbox_ready and self.shared:
+                await self._leave_shared()
+
+    async def _ack_after(self, key, entry_id, waits):
+        try:
+            await asyncio.gather(*waits, return_exceptions=True)
+            await self.r.xack(key, self.extension_id, entry_id)
+        finally:
+            self.unacked.discard((key, entry_id))
+
+    # Blocks until the connection has data, then drains every buffered message
+    async def _read_messages(self):
+        while True:
+            msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            while msg:
+                self.triage_raw(msg['channel'], msg['data'])
+                if self.inbox_ready and self.shared:
+                    await self._leave_shared()
+                msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+
+    # Legacy reader: one message per wakeup, waking up at least once a second
+    async def _poll_messages(self):
+        while True:
+            msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if msg:
+                self.triage_raw(msg['channel'], msg['data'])
+                if self.inbox_ready and self.shared:
+                    await self._leave_shared()
+
+    # Dispatches an inbound message as received from Redis. Everything but app messages is
+    # dropped without decoding, and the body is only decoded for messages somebody waits for.
+    def triage_raw(self, channel, raw):
+        self.metrics.count('messages.received')
+        routing = self._peek(channel, raw)
+        if routing is not None:
+            self._triage(channel, *routing)
+
+    # Decodes the routing fields of an inbound message: (extensionID, origin, responseID,
+    # event, data), or None for a message that is dropped
+    def _peek(self, channel, raw):
+        if '"app"' not in raw:
+            self.metrics.count('messages.ignored')
+            return
+        try:
+            if peek is None:
+                if self._foreign(raw):
+                    self.metrics.count('messages.ignored')
+                    return
+                msg = loads(raw)
+                if not isinstance(msg, dict):
+                    raise ValueError(f"expected an object, got {type(msg).__name__}")
+                return msg.get('extensionID'), msg.get('origin'), msg.get('responseID'), msg.get('event'), msg.get('data', {})
+            msg = peek(raw)
+            return msg.extensionID, msg.origin, msg.responseID, msg.event, msg.data
+        except DECODE_ERRORS as e:
+            # A malformed message is not a connection problem, skip it
+            self.decode_errors += 1
+            log("Malformed message on", repr(channel), f"({self.decode_errors} so far):", e, level='warning')
+
+    # A response for another extension: responseID and extensionID appear once and there is
+    # no event. Only the first and last 256 characters are looked at, the top-level fields sit
+    # there when the data is large. Anything the text doesn't settle (e.g. the names also occur
+    # in the data) is decoded and triaged as usual.
+    def _foreign(self, raw):
+        if len(raw) > 512:
+            raw = raw[:256] + raw[-256:]
+        if '"event"' in raw or raw.count('"responseID"') != 1 or raw.count('"extensionID"') != 1:
+            return False
+        match = _extension_id(raw, raw.index('"extensionID"'))
+        return match is not None and not self._ours(match.group(1))
+
+    def _ours(self, extension_id):
+        return extension_id == self.extension_id
 
     def triage_msg(self, channel, msg):
         # Ignore messages for other extensions
         if 'extensionID' in msg and msg['extensionID'] != self.extension_id:
             return
+        self._triage(channel, None, msg.get('origin'), msg.get('responseID'), msg.get('event'), msg.get('data', {}))
+
+    def _triage(self, channel, extension_id, origin, response_id, event, data):
+        # Ignore messages for other extensions
+        if extension_id is not None and extension_id != self.extension_id:
+            self.metrics.count('messages.ignored')
+            return
         # Ignore any messages broadcast by ourself (origin)
-        if msg.get('origin') != 'app':
+        if origin != 'app':
+            self.metrics.count('messages.ignored')
             return
-        
-        if channel == 'messages' and msg.get('responseID'):
+        # Directed messages are handled like the ones on the shared channel
+        if channel == self.inbox:
+            channel = 'messages'
+            # Replies alone don't mean events come here as well, only this event does
+            if event == 'directed' and not response_id:
+                self.inbox_ready = True
+                return
+
+        if channel == 'messages' and response_id:
             # Only handle incoming messages directed at our extension
-            self._handle_response(msg['responseID'], msg.get('data', {}))
+            self._handle_response(response_id, data)
         else:
-            for chan, handler in self.handlers.items():
-                if fnmatch(channel, chan):
-                    try:
-                        self.loop.create_task(handler(channel, msg['event'], msg.get('data', {})))
-                    except Exception as e:
-                        log("Event handler error raised: ", e)
-                    break
+            handlers = self.router.match(channel, event)
+            if not handlers:
+                self.metrics.count('messages.unhandled')
+                return
+            data = _body(data)
+            lane = self.lanes.get(channel)
+            if lane:
+                done = None
+                if self.acking is not None:
+                    done = self.loop.create_future()
+                    self.acking.append(done)
+                lane.put((channel, event, data, handlers, done))
+                return
+            for handler in handlers:
+                task = self._spawn(self._call(handler, channel, event, data))
+                if self.acking is not None:
+                    self.acking.append(task)
+
+    # The app replies on our inbox, stop receiving every other extension's traffic
+    async def _leave_shared(self):
+        self.shared = False
+        if self.transport == 'streams':
+            self.stream_ids.pop('stream:messages', None)
+        else:
+            await self.pubsub.unsubscribe('messages')
+        log("Using directed channel:", self.inbox)
 
     # Handles incoming responses on the 'messages' channel
     def _handle_response(self, responseID, msg):
-        if responseID in self.queue:
-            self.queue[responseID].set_result(msg)
-            del self.queue[responseID]
+        entry = self.queue.pop(responseID, None)
+        if entry and not entry[0].done():
+            try:
+                entry[0].set_result(_body(msg))
+            except DECODE_ERRORS as e:
+                self.decode_errors += 1
+                entry[0].set_exception(e)
+        else:
+            self.metrics.count('responses.unmatched')
+            log("Warning: no response handler found for responseID: ", responseID, level='warning')
+
+# Set while a Host loads an extension: MessageCenters created meanwhile take this extension_id
+hosting = None
+# The running Host, if any
+host = None
+
+# Runs several extensions in one process (see tools/host.py). Every extension keeps its own
+# MessageCenter, extension_id and Dictionary namespace, and their run() only registers them
+# here. One pubsub subscription to the union of their channels serves them all: each message
+# is decoded once and handed to the center its extensionID names, or to every center.
+class Host(MessageCenter):
+    def __init__(self, loop, **options):
+        if options.get('transport', 'pubsub') != 'pubsub':
+            # Stream consumer groups are per extension, a shared reader can't acknowledge for them
+            raise ValueError("Host only supports the pubsub transport")
+        super().__init__(loop, **options)
+        self.centers = []
+        # extension_id -> center
+        self.by_id = {}
+
+    def add(self, center):
+        self.centers.append(center)
+        self.by_id[center.extension_id] = center
+
+    def run(self):
+        self.loop.run_until_complete(self.listen_for_messages())
+
+    async def listen_for_messages(self):
+        for center in self.centers:
+            if center.sweeper is None:
+                center.sweeper = self.loop.create_task(center._sweep_requests())
+            if center.metrics_interval and center.metrics_task is None:
+                center.metrics_task = self.loop.create_task(center._log_metrics())
+        await super().listen_for_messages()
+
+    def _channels(self):
+        return set().union(*(center._channels() for center in self.centers))
+
+    def _patterns(self):
+        return set().union(*(center.router.patterns for center in self.centers))
+
+    def _fail_requests(self):
+        for center in self.centers:
+            center._fail_requests()
+
+    # Decodes a message once and hands it to the extension it is addressed to, or to every
+    # extension when it has no extensionID
+    def triage_raw(self, channel, raw):
+        self.metrics.count('messages.received')
+        routing = self._peek(channel, raw)
+        if routing is None:
+            return
+        extension_id = routing[0]
+        if extension_id is None:
+            centers = self.centers
+            if len(centers) > 1:
+                # the body is decoded once, not by every center that handles the event
+                try:
+                    routing = (*routing[:4], _body(routing[4]))
+                except DECODE_ERRORS as e:
+                    self.decode_errors += 1
+                    log("Malformed message on", repr(channel), f"({self.decode_errors} so far):", e, level='warning')
+                    return
         else:
-            log("Warning: no response handler found for responseID: ", responseID)
+            centers = [self.by_id[extension_id]] if extension_id in self.by_id else []
+            if not centers:
+                self.metrics.count('messages.ignored')
+        for center in centers:
+            center.metrics.count('messages.received')
+            center._triage(channel, *routing)
+        if self.shared:
+            # Leave 'messages' once every extension gets its traffic on its own inbox
+            self.inbox_ready = 'messages' not in self._channels()
+
+    def _ours(self, extension_id):
+        return extension_id in self.by_id
+
+    async def _leave_shared(self):
+        self.shared = False
+        await self.pubsub.unsubscribe('messages')
+        log("Using directed channels:", ', '.join(center.inbox for center in self.centers))
+
 
 class Dictionary:
     r = MessageCenter.r
 
-    def __init__(self, extension_id):
+    # cache: keep a local copy of read values, invalidated through Redis keyspace notifications
+    # notify_config: turn keyspace notifications on with CONFIG SET when they are off. This
+    # changes the configuration of the server, which the app and every extension share;
+    # without it the cache stays off on such a server.
+    # write_behind: buffer writes and flush them through a pipeline after flush_delay seconds,
+    # failed flushes are retried after retry_delay seconds
+    def __init__(self, extension_id, cache=False, write_behind=False, flush_delay=0.05,
+                 notify_config=False, retry_delay=1.0):
         self.extension_id = extension_id
+        # rkey -> (value, expires_at)
+        self.cache = {} if cache else None
+        self.cache_ready = None
+        self.notify_config = notify_config
+        self.invalidations = 0
+        # Counts local writes, a read that overlapped one doesn't cache what it got
+        self.local_writes = 0
+        self.write_behind = write_behind
+        self.flush_delay = flush_delay
+        self.retry_delay = retry_delay
+        # rkey -> (value, ttl), a None value is a pending delete
+        self.writes = {}
+        # The batch being sent by flush(), one at a time
+        self.flushing = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
 
     async def set(self, key, value, ttl=None):
         rkey = f"{self.extension_id}:{key}"
-        await self.r.set(rkey, value)
-        if ttl:
-            await self.r.expire(rkey, ttl)
+        self.local_writes += 1
+        if self.cache is not None:
+            self._cache_put(rkey, _as_str(value), ttl)
+        if self.write_behind:
+            self._buffer_write(rkey, value, ttl)
+            return
+        await self.r.set(rkey, value, ex=ttl)
 
     async def get(self, key):
         rkey = f"{self.extension_id}:{key}"
-        return await self.r.get(rkey)
+        # Buffered writes are newer than anything cached or stored
+        for writes in (self.writes, self.flushing):
+            if rkey in writes:
+                return _as_str(writes[rkey][0])
+        if self.cache is not None and await self._enable_cache():
+            entry = self.cache.get(rkey)
+            if entry and (entry[1] is None or entry[1] > time.monotonic()):
+                return entry[0]
+
+        invalidations = self.invalidations
+        local_writes = self.local_writes
+        value = await self.r.get(rkey)
+        # Don't cache a value that may have been invalidated or overwritten while it was being read
+        if (self.cache is not None and self.cache_ready and invalidations == self.invalidations
+                and local_writes == self.local_writes):
+            self._cache_put(rkey, value)
+        return value
 
     async def set_int(self, key, value):
         await self.set(key, str(value))
@@ -100,25 +1115,417 @@ class Dictionary:
 
     async def increment(self, key, amount=1):
         rkey = f"{self.extension_id}:{key}"
+        self.local_writes += 1
+        await self._flush_key(rkey)
         value = int(await self.r.incr(rkey, amount=amount))
+        if self.cache is not None:
+            self.cache.pop(rkey, None)
         return value
 
     async def set_json(self, key, data):
-        js_str = json.dumps(data)
+        js_str = dumps(data)
         await self.set(key, js_str)
 
     async def get_json(self, key):
         js_str = await self.get(key)
-        return json.loads(js_str or '{}')
+        return loads(js_str or '{}')
 
     async def pop(self, key):
         rkey = f"{self.extension_id}:{key}"
+        self.local_writes += 1
+        await self._flush_key(rkey)
+        if self.cache is not None:
+            self.cache.pop(rkey, None)
         return await self.r.getdel(rkey)
 
     async def remove(self, key):
         rkey = f"{self.extension_id}:{key}"
+        self.local_writes += 1
+        if self.cache is not None:
+            self._cache_put(rkey, None)
+        if self.write_behind:
+            self._buffer_write(rkey, None, None)
+            return
         await self.r.delete(rkey)
 
-# Log to stdout and flush after each line
-def log(*str):
-    print(datetime.now().strftime("%x %X.%f"), *str, flush=True)
+    # Appends to a Redis list in O(1), keeping only the newest maxlen items if given.
+    # Returns the new list length.
+    async def append(self, key, value, maxlen=None):
+        rkey = f"{self.extension_id}:{key}"
+        async def op():
+            async with self.r.pipeline() as pipe:
+                pipe.rpush(rkey, value)
+                if maxlen:
+                    pipe.ltrim(rkey, -maxlen, -1)
+                length = (await pipe.execute())[0]
+            return min(length, maxlen) if maxlen else length
+        return await self._list_op(rkey, op)
+
+    async def append_json(self, key, data, maxlen=None):
+        return await self.append(key, dumps(data), maxlen=maxlen)
+
+    # Items from start to end inclusive; negative indexes count from the tail
+    async def range(self, key, start=0, end=-1):
+        rkey = f"{self.extension_id}:{key}"
+        return await self._list_op(rkey, lambda: self.r.lrange(rkey, start, end))
+
+    async def range_json(self, key, start=0, end=-1):
+        return [loads(item) for item in await self.range(key, start, end)]
+
+    async def length(self, key):
+        rkey = f"{self.extension_id}:{key}"
+        return await self._list_op(rkey, lambda: self.r.llen(rkey))
+
+    async def pop_tail(self, key):
+        rkey = f"{self.extension_id}:{key}"
+        return await self._list_op(rkey, lambda: self.r.rpop(rkey))
+
+    async def pop_tail_json(self, key):
+        item = await self.pop_tail(key)
+        return None if item is None else loads(item)
+
+    # Keeps only the newest maxlen items
+    async def trim(self, key, maxlen):
+        rkey = f"{self.extension_id}:{key}"
+        if maxlen <= 0:
+            return await self.remove(key)
+        await self._list_op(rkey, lambda: self.r.ltrim(rkey, -maxlen, -1))
+
+    # Sorted set of members ordered by score, e.g. an index of ids. mapping is {member: score},
+    # adding a member again updates its score.
+    async def add_sorted(self, key, mapping):
+        rkey = f"{self.extension_id}:{key}"
+        await self._flush_key(rkey)
+        return await self.r.zadd(rkey, mapping)
+
+    # Members from start to end inclusive in score order, highest first with reverse
+    async def range_sorted(self, key, start=0, end=-1, reverse=False):
+        rkey = f"{self.extension_id}:{key}"
+        await self._flush_key(rkey)
+        return await self.r.zrange(rkey, start, end, desc=reverse)
+
+    async def _list_op(self, rkey, op):
+        await self._flush_key(rkey)
+        try:
+            return await op()
+        except redis.ResponseError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+            await self._convert_to_list(rkey)
+            return await op()
+
+    # Converts a JSON array stored with set_json into a Redis list holding the same items, each
+    # JSON-encoded like append_json does, so the *_json methods read them back
+    async def _convert_to_list(self, rkey):
+        items = loads(await self.r.get(rkey) or '[]')
+        async with self.r.pipeline() as pipe:
+            pipe.delete(rkey)
+            if items:
+                pipe.rpush(rkey, *[dumps(i) for i in items])
+            await pipe.execute()
+        if self.cache is not None:
+            self.cache.pop(rkey, None)
+        log(f"Converted {rkey} to a list of {len(items)} items")
+
+    # Sends all buffered writes to Redis in a single pipeline. Returns False when that failed,
+    # the writes stay buffered and are retried.
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.writes:
+                return True
+            batch, self.writes = self.writes, {}
+            self.flushing = batch
+            try:
+                async with self.r.pipeline(transaction=False) as pipe:
+                    for rkey, (value, ttl) in batch.items():
+                        if value is None:
+                            pipe.delete(rkey)
+                        else:
+                            pipe.set(rkey, value, ex=ttl)
+                    await pipe.execute()
+            except Exception as e:
+                log("Dictionary flush failed, will retry: ", e, level='warning')
+                # Keep the writes, unless they were superseded in the meantime
+                for rkey, write in batch.items():
+                    self.writes.setdefault(rkey, write)
+                self._schedule_flush()
+                return False
+            finally:
+                self.flushing = {}
+        return True
+
+    def _buffer_write(self, rkey, value, ttl):
+        self.writes[rkey] = (value, ttl)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    # Flushes until nothing is buffered, writes made while a flush runs (or that failed)
+    # are picked up by the next round of the same task
+    async def _flush_later(self):
+        delay = self.flush_delay
+        while self.writes:
+            await asyncio.sleep(delay)
+            delay = self.flush_delay if await self.flush() else self.retry_delay
+
+    # Commands that read and write on the server must see our buffered writes first
+    async def _flush_key(self, rkey):
+        if rkey in self.writes or rkey in self.flushing:
+            await self.flush()
+
+    def _cache_put(self, rkey, value, ttl=None):
+        self.cache[rkey] = (value, time.monotonic() + ttl if ttl else None)
+
+    # Enables keyspace notifications and subscribes to our own keys before anything gets cached.
+    # Returns False (and disables caching) when the server doesn't allow it.
+    async def _enable_cache(self):
+        if self.cache_ready is None:
+            self.cache_ready = asyncio.get_running_loop().create_future()
+            try:
+                flags = (await self.r.config_get('notify-keyspace-events')).get('notify-keyspace-events', '')
+                if 'K' not in flags or not ('A' in flags or set('g$lx') <= set(flags)):
+                    if not self.notify_config:
+                        raise RuntimeError(f"keyspace notifications are off (notify-keyspace-events '{flags}')")
+                    await self.r.config_set('notify-keyspace-events', ''.join(sorted(set(flags + 'Kg$lxe'))))
+                db = self.r.connection_pool.connection_kwargs.get('db', 0)
+                prefix = f"__keyspace@{db}__:"
+                pubsub = self.r.pubsub()
+                await pubsub.psubscribe(f"{prefix}{self.extension_id}:*")
+                asyncio.get_running_loop().create_task(self._invalidate(pubsub, prefix))
+                self.cache_ready.set_result(True)
+            except Exception as e:
+                log("Dictionary cache disabled: ", e, level='warning')
+                self.cache = None
+                self.cache_ready.set_result(False)
+        return await self.cache_ready
+
+    async def _invalidate(self, pubsub, prefix):
+        while True:
+            try:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                while msg:
+                    self.invalidations += 1
+                    self.cache.pop(msg['channel'][len(prefix):], None)
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+            except asyncio.CancelledError:
+                raise
+            except:
+                # Notifications may have been missed while disconnected
+                self.invalidations += 1
+                self.cache.clear()
+                await asyncio.sleep(1)
+
+# Bounded LRU cache of strings, e.g. rendered HTML fragments. With a Dictionary as store,
+# entries are also kept in Redis for ttl seconds: they survive a restart and a miss in memory
+# is looked up there before the caller recomputes the value. There is no explicit
+# invalidation, put a content version in the key instead and let old entries age out.
+class LRUCache:
+    def __init__(self, maxsize=100, store=None, ttl=86400):
+        self.maxsize = maxsize
+        self.store = store
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        elif self.store is not None:
+            value = await self.store.get(f"lru:{key}")
+            if value is not None:
+                self._put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value):
+        self._put(key, value)
+        if self.store is not None:
+            await self.store.set(f"lru:{key}", value, self.ttl)
+
+    def _put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+# sql.runSQL takes no bound parameters (yet), so sql() writes the values into the query as
+# escaped SQL literals. Set sql_params to True for an app that binds a "params" list to the
+# ? placeholders: the query text then stays the same and the app can reuse its statement.
+sql_params = False
+
+# Statement text is split once per distinct query on its ? placeholders, a literal ? in the
+# query text isn't supported. Line breaks are kept: a -- comment ends at the end of its line.
+@functools.lru_cache(maxsize=256)
+def _statement(query):
+    text = query.strip()
+    return text, text.split('?')
+
+def _literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError(f"Can't write {value} as an SQL literal")
+        return repr(value)
+    if isinstance(value, (bytes, bytearray)):
+        return f"X'{bytes(value).hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Runs query through sql.runSQL with params in place of its ? placeholders and returns the
+# rows. Columns named in json_columns hold JSON text and are decoded. row turns each dict into
+# a typed row: a msgspec Struct, a dataclass or anything else called with the columns as
+# keyword arguments.
+async def sql(message_center, query, params=(), db=None, row=None, json_columns=()):
+    text, parts = _statement(query)
+    params = list(params)
+    if len(params) != len(parts) - 1:
+        raise ValueError(f"{len(parts) - 1} parameters expected, got {len(params)}")
+    data = {"sql": text}
+    if not sql_params:
+        data["sql"] = parts[0] + ''.join(_literal(p) + part for p, part in zip(params, parts[1:]))
+    elif params:
+        data["params"] = params
+    if db:
+        data["db"] = db
+    response = await message_center.send_message({"event": "sql.runSQL", "data": data})
+    if isinstance(response, dict) and response.get('error'):
+        raise SQLError(response['error'])
+    rows = (response.get('result') if isinstance(response, dict) else response) or []
+    for r in rows:
+        for column in json_columns:
+            if isinstance(r.get(column), (str, bytes)):
+                r[column] = loads(r[column])
+    if row is None:
+        return rows
+    if msgspec and isinstance(row, type) and issubclass(row, msgspec.Struct):
+        return msgspec.convert(rows, list[row])
+    return [row(**r) for r in rows]
+
+def _as_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+# Lines below log_level are dropped before any formatting. log_format is 'text' or 'json'.
+log_level = LEVELS.get(os.environ.get('REMYND_LOG_LEVEL', 'info'), 20)
+log_format = os.environ.get('REMYND_LOG_FORMAT', 'text')
+# At most log_burst identical lines per log_window seconds
+log_burst = 20
+log_window = 10.0
+
+# Writes log records to stdout from a background thread, so the event loop never waits for
+# the console. Timestamps and JSON records are formatted on that thread too.
+class LogSink:
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        # line -> [window start, lines in window, suppressed lines], shared with the writer thread
+        self.repeats = {}
+        self.lock = threading.Lock()
+
+    def put(self, level, text, fields):
+        now = time.time()
+        with self.lock:
+            repeat = self.repeats.get(text)
+            if repeat is None or now - repeat[0] > log_window:
+                if repeat and repeat[2]:
+                    self._suppressed(now, text, repeat[2])
+                if len(self.repeats) > 1000:
+                    self._expire(now)
+                    if len(self.repeats) > 1000:
+                        self.repeats.clear()
+                repeat = self.repeats[text] = [now, 0, 0]
+            repeat[1] += 1
+            if repeat[1] > log_burst:
+                repeat[2] += 1
+                return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write, name='remynd-log', daemon=True)
+            self.thread.start()
+        self.queue.put((now, level, text, fields))
+
+    # Ends the windows older than log_window and reports what they suppressed. The writer
+    # thread calls it every second, so a count doesn't wait for the same line to come back.
+    def _expire(self, now):
+        for text, repeat in list(self.repeats.items()):
+            if now - repeat[0] > log_window:
+                del self.repeats[text]
+                if repeat[2]:
+                    self._suppressed(now, text, repeat[2])
+
+    def _suppressed(self, now, text, count):
+        self.queue.put((now, 'warning', f"({count} identical lines suppressed) {text[:200]}", {}))
+
+    def _write(self):
+        while True:
+            try:
+                records = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                records = []
+            with self.lock:
+                self._expire(time.time())
+            while not self.queue.empty():
+                records.append(self.queue.get_nowait())
+            lines = [self._format(*record) for record in records if record is not None]
+            if lines:
+                sys.stdout.write(''.join(lines))
+                sys.stdout.flush()
+            if None in records:
+                return
+
+    def _format(self, ts, level, text, fields):
+        if log_format == 'json':
+            record = {"time": datetime.fromtimestamp(ts).isoformat(), "level": level, "msg": text}
+            record.update(fields)
+            return json.dumps(record, default=str) + '\n'
+        line = datetime.fromtimestamp(ts).strftime("%x %X.%f") + ' '
+        if level != 'info':
+            line += level.upper() + ': '
+        line += text
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        return line + '\n'
+
+    # Writes out everything queued so far, called at exit
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=2)
+            self.thread = None
+
+sink = LogSink()
+atexit.register(sink.close)
+
+# Log argument that is only computed when the line is actually logged:
+# log("Call:", lazy(json.dumps, msg, indent=4), level='debug')
+class lazy:
+    __slots__ = ('fn', 'args', 'kwargs')
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.fn(*self.args, **self.kwargs))
+
+# Log to stdout like print(). Wrap expensive arguments in lazy() to skip them when the level
+# is disabled. Keyword arguments are extra fields of the record.
+def log(*args, level='info', **fields):
+    if LEVELS[level] < log_level:
+        return
+    sink.put(level, ' '.join(str(arg) for arg in args), fields)
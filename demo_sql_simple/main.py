@@ -58,6 +58,15 @@ async def showWindow(query, result=''):
     remynd.log("HTML rendered in window: ", window_id)
     await kvstore.set_int('window_id', window_id)
 
+# Pretty-prints a query result. Slow for big results, so it runs in remynd.run_blocking
+def format_result(result):
+    json_text = json.dumps(result, indent=4)
+    # workaround to decode \uXXXX uncicode symbols
+    codepoint = re.compile(r'(\\u[0-9a-fA-F]{4})')
+    def replace(match):
+        return chr(int(match.group(1)[2:], 16))
+    return codepoint.sub(replace, json_text)
+
 async def handleJSCallback(msg):
     print('Execute:', msg)
     query = msg.get('query')
@@ -79,21 +88,15 @@ async def handleJSCallback(msg):
         print("Response: ", response)
         return
 
-    json_text = json.dumps(result, indent=4)
-    # workaround to decode \uXXXX uncicode symbols
-    codepoint = re.compile(r'(\\u[0-9a-fA-F]{4})')
-    def replace(match):
-        return chr(int(match.group(1)[2:], 16))
-    json_text = codepoint.sub(replace, json_text)
+    json_text = await remynd.run_blocking(format_result, result)
 
     await showWindow(query, json_text)
 
-# Handler for incoming events on the 'messages' channel
-async def msg_handler(channel, event, msg):
-    if event == 'jsEventFired':
-        await handleJSCallback(msg)
+# Handler for 'jsEventFired' events on the 'messages' channel
+async def js_handler(channel, event, msg):
+    await handleJSCallback(msg)
 
 loop.create_task(showWindow('SELECT * FROM FrameOCR LIMIT 10;'))
-message_center.subscribe('messages', msg_handler)
+message_center.subscribe('messages', 'jsEventFired', js_handler)
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
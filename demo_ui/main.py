@@ -155,7 +155,7 @@ async def showWindow(result=''):
     await kvstore.set_int('window_id', window_id)
 
     # small timeout needed to let DOM load properly
-    time.sleep(0.5)
+    await asyncio.sleep(0.5)
     await loadCalls(get_timestamp())
 
 async def loadCalls(before, after=0):
@@ -166,20 +166,12 @@ async def loadCalls(before, after=0):
         return
     
     if after:
-        sql = f"SELECT id, title, participants, endDate FROM Call WHERE id > {after} ORDER BY id ASC LIMIT 10;"
+        sql = "SELECT id, title, participants, endDate FROM Call WHERE id > ? ORDER BY id ASC LIMIT 10;"
     else:
-        sql = f"SELECT id, title, participants, endDate FROM Call WHERE id < {before} ORDER BY id DESC LIMIT 10;"
+        sql = "SELECT id, title, participants, endDate FROM Call WHERE id < ? ORDER BY id DESC LIMIT 10;"
     
-    msg = {
-        "event": "sql.runSQL",
-        "data": {
-            "sql": sql,
-            "db": "extras"
-        }
-    }
     remynd.log("Sending sql request...")
-    response = await message_center.send_message(msg)
-    result = response.get('result')
+    result = await remynd.sql(message_center, sql, (after or before,), db="extras")
 
     if not result:
         return False
@@ -305,7 +297,7 @@ async def showSettings():
 
 async def callSummary(call):
     call_id = call['id']
-    remynd.log('Summarize call: ', json.dumps(call, indent=4))
+    remynd.log('Summarize call: ', remynd.lazy(json.dumps, call, indent=4), level='debug')
     script_msg = {
         "event": "layerScript.run",
         "data": {
@@ -393,25 +385,19 @@ async def windowList(msg):
     msg = await message_center.send_message(img_msg)
     imageData = msg.get('imageData')
 
-    sql_msg = {
-        "event": "sql.runSQL",
-        "data": {
-            "sql": f"""
-                select ApplicationWindow.id, name, localizedName, bundleIdentifier from ApplicationWindow 
-                join ApplicationRun on ApplicationWindow.applicationRunId = ApplicationRun.id
-                join Application on ApplicationRun.applicationId = Application.id
-                where firstSeenAt <= DATETIME({ts}, 'auto') and lastSeenAt >= DATETIME({ts}, 'auto')
-            """
-        }
-    }
     remynd.log("Sending runSQL request")
-    msg = await message_center.send_message(sql_msg)
+    windows = await remynd.sql(message_center, """
+        select ApplicationWindow.id, name, localizedName, bundleIdentifier from ApplicationWindow 
+        join ApplicationRun on ApplicationWindow.applicationRunId = ApplicationRun.id
+        join Application on ApplicationRun.applicationId = Application.id
+        where firstSeenAt <= DATETIME(?, 'auto') and lastSeenAt >= DATETIME(?, 'auto')
+    """, (ts, ts))
 
-    print(msg)
+    print(windows)
 
     wnd_list = '\n'.join(map(lambda w: f"""
         <li>{escape(w['localizedName']) + ' (' + escape(w['bundleIdentifier']) + ')' + '<br>' + escape(w['name'] or 'n/a')}</li>
-    """, msg['result']))
+    """, windows))
 
     html = """
         <html>
@@ -613,61 +599,72 @@ async def handleJSCallback(msg):
 
 # Handler for incoming events on the 'ui' channel
 async def ui_handler(channel, event, msg):
-    print(f"{event}:\n", json.dumps(msg, indent=4))
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
 
-    if event == 'positionDidChange':
-        print(msg)
-        if await kvstore.get_int('list_window_id'):
-            await windowList(msg)
-#     elif event == 'notificationCallback':
-#         await handleNotificationCallback(msg)
+async def position_handler(channel, event, msg):
+    if await kvstore.get_int('list_window_id'):
+        await windowList(msg)
 
-# Handler for incoming events on the 'message' channel
+# Handlers for incoming events on the 'message' channel
 async def msg_handler(channel, event, msg):
-    print(f"{event}:\n", json.dumps(msg, indent=4))
-
-    if event == 'uiPlayground':
-        await showWindow()
-    elif event == 'settings':
-        await showSettings()
-    elif event == 'jsEventFired':
-        await handleJSCallback(msg)
-    elif event == 'windowWillClose':
-        if msg['windowID'] == await kvstore.get_int('window_id'):
-            await kvstore.remove('window_id')
-        elif msg['windowID'] == await kvstore.get_int('settings_window_id'):
-            await kvstore.remove('settings_window_id')
-        elif msg['windowID'] == await kvstore.get_int('list_window_id'):
-            await kvstore.remove('list_window_id')
-    elif event == 'callSummary':
-        call = msg.get('call')
-        if call:
-            await callSummary(call)
-    elif event == 'windowList':
-        await windowList(msg)
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
+
+async def playground_handler(channel, event, msg):
+    await showWindow()
+
+async def settings_handler(channel, event, msg):
+    await showSettings()
+
+async def js_handler(channel, event, msg):
+    await handleJSCallback(msg)
+
+async def close_handler(channel, event, msg):
+    if msg['windowID'] == await kvstore.get_int('window_id'):
+        await kvstore.remove('window_id')
+    elif msg['windowID'] == await kvstore.get_int('settings_window_id'):
+        await kvstore.remove('settings_window_id')
+    elif msg['windowID'] == await kvstore.get_int('list_window_id'):
+        await kvstore.remove('list_window_id')
+
+async def summary_handler(channel, event, msg):
+    call = msg.get('call')
+    if call:
+        await callSummary(call)
+
+async def window_list_handler(channel, event, msg):
+    await windowList(msg)
 
 # Handler for incoming events on the 'recorder' channel
 async def recorder_handler(channel, event, msg):
-    print(f"{event}:\n", json.dumps(msg, indent=4))
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
     # if event == 'didCaptureFrame':
     #     await handleDidCaptureFrame(msg)
 
 # Handler for incoming events on the 'system' channel
 async def sys_handler(channel, event, msg):
-    print(f"{event}:\n", json.dumps(msg, indent=4))
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
 
 # Handler for incoming events on the 'call' channel
 async def call_handler(channel, event, msg):
-    print(f"{event}:\n", json.dumps(msg, indent=4))
+    remynd.log(f"{event}:\n", remynd.lazy(json.dumps, msg, indent=4), level='debug')
 
 # loop.create_task(showWindow())
 loop.create_task(register())
 # loop.create_task(check_recording_task(1, 0))
 message_center.subscribe('ui', ui_handler)
+message_center.subscribe('ui', 'positionDidChange', position_handler)
 message_center.subscribe('messages', msg_handler)
+message_center.subscribe('messages', 'uiPlayground', playground_handler)
+message_center.subscribe('messages', 'settings', settings_handler)
+message_center.subscribe('messages', 'jsEventFired', js_handler)
+message_center.subscribe('messages', 'windowWillClose', close_handler)
+message_center.subscribe('messages', 'callSummary', summary_handler)
+message_center.subscribe('messages', 'windowList', window_list_handler)
 message_center.subscribe('system', sys_handler)
 message_center.subscribe('calls', call_handler)
 message_center.subscribe('recorder', recorder_handler)
+message_center.limit('system', maxsize=100)
+message_center.limit('recorder', maxsize=100)
 
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
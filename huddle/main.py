@@ -168,25 +168,26 @@ async def check_slack_running():
     else:
         remynd.log("Slack not running, will observe app launch")
 
-async def sys_handler(channel, event, msg):
-    if event == 'applicationDidLaunch':
-        if 'bundleID' in msg and msg['bundleID'] == 'com.tinyspeck.slackmacgap':
-            # Slack launched; poll huddle status
-            remynd.log("Slack launched")
-            global poll_task
-            pid = msg['pid']
-            poll_task = loop.create_task(poll_slack_ax(pid))
-    elif event == 'applicationDidTerminate':
-        if 'bundleID' in msg and msg['bundleID'] == 'com.tinyspeck.slackmacgap':
-            # Slack no longer running; cancel polling
-            remynd.log("Slack terminated")
-            poll_task.cancel()
+async def launch_handler(channel, event, msg):
+    if 'bundleID' in msg and msg['bundleID'] == 'com.tinyspeck.slackmacgap':
+        # Slack launched; poll huddle status
+        remynd.log("Slack launched")
+        global poll_task
+        pid = msg['pid']
+        poll_task = loop.create_task(poll_slack_ax(pid))
+
+async def terminate_handler(channel, event, msg):
+    if 'bundleID' in msg and msg['bundleID'] == 'com.tinyspeck.slackmacgap':
+        # Slack no longer running; cancel polling
+        remynd.log("Slack terminated")
+        poll_task.cancel()
 
 # Check once at startup if Slack is already running
 # loop.create_task(check_slack_running())
 loop.create_task(check_slack_running())
 
 # Register event handler and start the message center
-message_center.subscribe('system', sys_handler)
+message_center.subscribe('system', 'applicationDidLaunch', launch_handler)
+message_center.subscribe('system', 'applicationDidTerminate', terminate_handler)
 remynd.log("Waiting for Slack huddles...")
 message_center.run() # Will run forever
\ No newline at end of file
@@ -4,6 +4,7 @@ import json
 import uuid
 import time
 import os
+import functools
 from datetime import datetime, timezone
 from base64 import b64encode
 
@@ -36,6 +37,8 @@ def date_str_hr(ts):
 def time_str(ts):
     return datetime.fromtimestamp(ts).strftime("%X")
 
+# assets don't change while running, read each one once
+@functools.lru_cache(maxsize=None)
 def encode_image(path):
     with open(os.path.dirname(__file__) + '/' + path, "rb") as f:
         return b64encode(f.read()).decode('ascii')
@@ -46,6 +49,10 @@ env.globals['dateStr'] = date_str
 env.globals['timeStr'] = time_str
 env.globals['dumps'] = json.dumps
 
+# Renders a template off the event loop (templates read images from disk and can be large)
+async def render(name, **context):
+    return await remynd.run_blocking(lambda: env.get_template(name).render(**context))
+
 async def register():
     remynd.log("Extension ID:", message_center.extension_id)
 
@@ -68,7 +75,7 @@ async def register():
     }
 
     reg_resp = await message_center.send_message(reg_msg)
-    remynd.log("Registration:", json.dumps(reg_resp, indent=4))
+    remynd.log("Registration:", remynd.lazy(json.dumps, reg_resp, indent=4))
 
     await kvstore.remove('window_id')
     # await kvstore.remove('ocr_list')
@@ -109,7 +116,7 @@ async def showWindow(html, prev=None, next=None, tag="main"):
         await kvstore.remove("hidden")
 
 async def renderActivity():
-    activity = await kvstore.get_json("activity") or []
+    activity = await kvstore.range_json("activity")
 
     dates = []
 
@@ -133,9 +140,8 @@ async def renderActivity():
                 except:
                     pass
 
-    image_data = image_data or encode_image("assets/images/5a3187eb-90c8-4a0e-bf98-bb293ba809a6.png")
-    template = env.get_template("activity.html")
-    html = template.render(activity=activity, dates=dates, icon=image_data, cost=f"{day_spent:.03f}")
+    image_data = image_data or await remynd.run_blocking(encode_image, "assets/images/5a3187eb-90c8-4a0e-bf98-bb293ba809a6.png")
+    html = await render("activity.html", activity=activity, dates=dates, icon=image_data, cost=f"{day_spent:.03f}")
     await showWindow(html)
 
 async def ai_prompt_task(ocr_list):
@@ -163,7 +169,7 @@ async def ai_prompt_task(ocr_list):
         }
     }
     response = await message_center.send_message(msg)
-    print("AI response: ", response)
+    remynd.log("AI response:", response, level='debug')
 
     remynd.log("Got AI reply, trigger UI notification...")
 
@@ -180,16 +186,13 @@ async def ai_prompt_task(ocr_list):
         # response = await message_center.send_message(msg)
         # print("Notification id: ", response)
 
-        activity = await kvstore.get_json("activity") or []
-        activity.append({
+        await kvstore.append_json("activity", {
             'app_name': ocr_list[-1].get('app_name'),
             'bundle_id': ocr_list[-1].get('bundle_id'),
             'timestamp': ocr_list[-1].get('timestamp'),
             'summary': response['text'],
             'cost': f"{response.get('cost', 0):.03f}"
-        })
-
-        await kvstore.set_json("activity", activity)
+        }, maxlen=1000)
 
         if not await kvstore.get("hidden"):
             await renderActivity()
@@ -224,17 +227,17 @@ async def performOCR(interval):
     ocr_list = []
 
     async with ocr_lock:
-        for i in range(n):
-            timestamp = interval[0] + ((interval[1] - interval[0]) / n) * (i + 0.5)
-
-            msg = {
-                "event": "recorder.getFrameOCR",
-                "data": {
-                    "timestamp": timestamp
-                }
+        timestamps = [interval[0] + ((interval[1] - interval[0]) / n) * (i + 0.5) for i in range(n)]
+        msgs = [{
+            "event": "recorder.getFrameOCR",
+            "data": {
+                "timestamp": timestamp
             }
-            response = await message_center.send_message(msg)
+        } for timestamp in timestamps]
+        # all frames are independent, request them in a single round trip
+        responses = await message_center.send_many(msgs)
 
+        for timestamp, response in zip(timestamps, responses):
             if not response.get('text'):
                 remynd.log("Got empty OCR result:", response)
                 continue
@@ -319,48 +322,46 @@ async def handleUserActivity(timestamp):
         await kvstore.set_json("activity_intervals", intervals)
         await performOCR_task()
 
-# Handler for incoming events on the 'message' channel
-async def msg_handler(channel, event, msg):
-    # print(f"{event}:\n", json.dumps(msg, indent=4))
+# Handlers for incoming events on the 'messages' channel
+async def launch_handler(channel, event, msg):
+    await renderActivity()
 
-    if event == 'launch':
-        await renderActivity()
+async def ocr_handler(channel, event, msg):
+    last_frame = await kvstore.get_json("last_frame")
+    if not last_frame or (get_timestamp() - int(last_frame['timestamp']) > 30):
+        remynd.log("performOCR event received but recording is not running")
+        await showNotification("Screen recording\nis not active!")
         return
+    await performOCR((last_frame['timestamp'] - 60, last_frame['timestamp']))
 
-    if event == 'performOCR':
-        last_frame = await kvstore.get_json("last_frame")
-        if not last_frame or (get_timestamp() - int(last_frame['timestamp']) > 30):
-            remynd.log("performOCR event received but recording is not running")
-            await showNotification("Screen recording\nis not active!")
-            return
-        await performOCR((last_frame['timestamp'] - 60, last_frame['timestamp']))
-        return
-    
-    if event == 'windowWillClose':
-        await kvstore.remove('window_id')
-        await kvstore.set("hidden", 1)
-        return
+async def close_handler(channel, event, msg):
+    await kvstore.remove('window_id')
+    await kvstore.set("hidden", 1)
 
-# Handler for incoming events on the 'system' channel
-async def system_handler(channel, event, msg):
-    if event in ('leftMouseUp', 'keyUp', 'scrollWheel'):
-        await handleUserActivity(msg['timestamp'])
-        return
+# Handler for user input events on the 'system' channel.
+# Typing and scrolling fire many events per second, a couple of seconds resolution is enough.
+@message_center.throttle(2.0)
+async def activity_handler(channel, event, msg):
+    await handleUserActivity(msg['timestamp'])
 
-# Handler for incoming events on the 'recorder' channel
-async def recorder_handler(channel, event, msg):
-    if event == 'didCaptureFrame':
-        # remynd.log("Frame grabbed:", msg)
-        await kvstore.set_json("last_frame", msg)
-        return
+# Handler for 'didCaptureFrame' events on the 'recorder' channel
+async def frame_handler(channel, event, msg):
+    # remynd.log("Frame grabbed:", msg)
+    await kvstore.set_json("last_frame", msg)
 
-    # if event == 'didCaptureOCR':
-    #     await handleDidCaptureOCR(msg)
+# async def ocr_captured_handler(channel, event, msg):
+#     await handleDidCaptureOCR(msg)
 
 loop.create_task(register())
 # message_center.subscribe('ui', ui_handler)
-message_center.subscribe('messages', msg_handler)
-message_center.subscribe('system', system_handler)
-message_center.subscribe('recorder', recorder_handler)
+message_center.subscribe('messages', 'launch', launch_handler)
+message_center.subscribe('messages', 'performOCR', ocr_handler)
+message_center.subscribe('messages', 'windowWillClose', close_handler)
+for event in ('leftMouseUp', 'keyUp', 'scrollWheel'):
+    message_center.subscribe('system', event, activity_handler)
+message_center.subscribe('recorder', 'didCaptureFrame', frame_handler)
+# frame events arrive in bursts, only the latest one matters
+message_center.limit('recorder', policy='coalesce')
+# message_center.subscribe('recorder', 'didCaptureOCR', ocr_captured_handler)
 remynd.log("Waiting for extension triggers...")
 message_center.run() # Will run forever
@@ -0,0 +1,133 @@
+# Dictionary write-behind and cache paths against fakeredis: python -m pytest tests
+import asyncio
+import os
+import sys
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'copilot'))
+import remynd
+
+
+@pytest.fixture
+def client():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    remynd._client = client
+    yield client
+    remynd._client = None
+
+
+def slow_pipeline(client, delay=0.05, failures=0):
+    pipeline = client.pipeline
+    state = {'failures': failures}
+
+    def factory(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def slow_execute(*a, **kw):
+            await asyncio.sleep(delay)
+            if state['failures']:
+                state['failures'] -= 1
+                raise ConnectionError("Redis is down")
+            return await execute(*a, **kw)
+        pipe.execute = slow_execute
+        return pipe
+    client.pipeline = factory
+
+
+def test_failed_flush_is_retried(client):
+    async def main():
+        slow_pipeline(client, delay=0, failures=2)
+        kvstore = remynd.Dictionary('test', write_behind=True, flush_delay=0.01, retry_delay=0.02)
+        await kvstore.set('entity', 'call:1')
+        await asyncio.sleep(0.2)
+        assert kvstore.writes == {}
+        assert await client.get('test:entity') == 'call:1'
+    asyncio.run(main())
+
+
+def test_concurrent_flush_keeps_batch_visible(client):
+    async def main():
+        slow_pipeline(client)
+        kvstore = remynd.Dictionary('test', write_behind=True, flush_delay=10)
+        await kvstore.set('a', '1')
+        first = asyncio.create_task(kvstore.flush())
+        await asyncio.sleep(0.01)
+        await kvstore.set('b', '2')
+        second = asyncio.create_task(kvstore.flush())
+        await asyncio.sleep(0.01)
+        # 'a' is on its way to the server, 'b' waits for the first flush to finish
+        assert await kvstore.get('a') == '1'
+        assert await kvstore.get('b') == '2'
+        assert await first and await second
+        assert await client.mget('test:a', 'test:b') == ['1', '2']
+        kvstore.flush_task.cancel()
+    asyncio.run(main())
+
+
+def test_get_sees_buffered_write_before_cache(client):
+    async def main():
+        kvstore = remynd.Dictionary('test', cache=True, write_behind=True, flush_delay=10)
+        kvstore.cache_ready = asyncio.get_running_loop().create_future()
+        kvstore.cache_ready.set_result(True)
+        kvstore.cache['test:entity'] = ('call:1', None)
+        await kvstore.set('entity', 'call:2')
+        kvstore.cache['test:entity'] = ('call:1', None)
+        assert await kvstore.get('entity') == 'call:2'
+        kvstore.flush_task.cancel()
+    asyncio.run(main())
+
+
+def test_get_racing_set_does_not_cache_old_value(client):
+    async def main():
+        await client.set('test:entity', 'call:1')
+        kvstore = remynd.Dictionary('test', cache=True)
+        kvstore.cache_ready = asyncio.get_running_loop().create_future()
+        kvstore.cache_ready.set_result(True)
+        get = client.get
+
+        async def slow_get(*args):
+            value = await get(*args)
+            await asyncio.sleep(0.05)
+            return value
+        client.get = slow_get
+
+        read = asyncio.create_task(kvstore.get('entity'))
+        await asyncio.sleep(0.01)
+        await kvstore.set('entity', 'call:2')
+        assert await read == 'call:1'
+        assert await kvstore.get('entity') == 'call:2'
+    asyncio.run(main())
+
+
+def test_cache_needs_notify_config_to_change_server(client):
+    async def main():
+        changes = []
+
+        async def config_get(name):
+            return {name: ''}
+
+        async def config_set(name, value):
+            changes.append((name, value))
+        client.config_get = config_get
+        client.config_set = config_set
+
+        kvstore = remynd.Dictionary('test', cache=True)
+        await kvstore.set('entity', 'call:1')
+        assert await kvstore.get('entity') == 'call:1'
+        assert kvstore.cache is None
+        assert changes == []
+    asyncio.run(main())
+
+
+def test_set_json_array_converts_to_json_list(client):
+    async def main():
+        kvstore = remynd.Dictionary('test')
+        await kvstore.set_json('history', ['call:1', {'id': 2}, 3])
+        await kvstore.append_json('history', 'person:John Galt')
+        assert await kvstore.range_json('history') == ['call:1', {'id': 2}, 3, 'person:John Galt']
+        assert await kvstore.pop_tail_json('history') == 'person:John Galt'
+        assert await kvstore.range_json('history', -1) == [3]
+    asyncio.run(main())
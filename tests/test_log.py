@@ -0,0 +1,46 @@
+# remynd.log argument handling and rate limiting: python -m pytest tests
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'copilot'))
+import remynd
+
+
+def records(sink):
+    items = []
+    while not sink.queue.empty():
+        items.append(sink.queue.get_nowait())
+    return [(level, text) for _, level, text, _ in items]
+
+
+def test_only_lazy_arguments_are_called(monkeypatch):
+    sink = remynd.LogSink()
+    sink.thread = object()
+    monkeypatch.setattr(remynd, 'sink', sink)
+    called = []
+
+    class Value:
+        def __init__(self):
+            called.append('Value')
+
+    remynd.log("class", Value)
+    remynd.log("skipped", remynd.lazy(called.append, 'debug'), level='debug')
+    remynd.log("computed", remynd.lazy(lambda: 'x' * 3))
+    assert called == []
+    assert records(sink) == [('info', f"class {Value}"), ('info', "computed xxx")]
+
+
+def test_rate_limit_keys_on_the_whole_line(monkeypatch):
+    monkeypatch.setattr(remynd, 'log_burst', 2)
+    sink = remynd.LogSink()
+    sink.thread = object()
+    for i in range(3):
+        sink.put('info', f"Call loaded: {i}", {})
+    for i in range(4):
+        sink.put('info', "Call loaded: 0", {})
+    assert len(records(sink)) == 4
+
+    # the writer thread reports the count once the window is over
+    sink._expire(time.time() + remynd.log_window + 1)
+    assert records(sink) == [('warning', "(3 identical lines suppressed) Call loaded: 0")]
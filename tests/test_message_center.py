@@ -0,0 +1,108 @@
+# MessageCenter inbound triage: python -m pytest tests
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'copilot'))
+import remynd
+
+
+def center():
+    return remynd.MessageCenter(asyncio.new_event_loop())
+
+
+def test_foreign_response_is_dropped_undecoded(monkeypatch):
+    monkeypatch.setattr(remynd, 'peek', None)
+    message_center = center()
+    blob = 'x' * 100000
+    for msg in ({"responseID": "r", "extensionID": "other", "origin": "app", "data": {"blob": blob}},
+                {"data": {"blob": blob}, "origin": "app", "responseID": "r", "extensionID": "other"}):
+        assert message_center._foreign(json.dumps(msg))
+    monkeypatch.setattr(remynd, 'loads', None)
+    message_center.triage_raw('messages', json.dumps(msg))
+    assert message_center.metrics.counters['messages.ignored'] == 1
+
+
+def test_ambiguous_messages_are_decoded(monkeypatch):
+    monkeypatch.setattr(remynd, 'peek', None)
+    message_center = center()
+    ours = message_center.extension_id
+    for msg in ({"event": "x", "origin": "app", "data": {"responseID": "r", "extensionID": "other"}},
+                {"responseID": "r", "extensionID": ours, "origin": "app", "data": {"extensionID": "other"}},
+                {"responseID": "r", "extensionID": ours, "origin": "app", "data": {}}):
+        assert not message_center._foreign(json.dumps(msg))
+
+
+def test_host_decodes_once_and_dispatches_by_extension_id(monkeypatch):
+    monkeypatch.setattr(remynd, 'peek', None)
+    decoded = []
+
+    def loads(raw):
+        decoded.append(raw)
+        return json.loads(raw)
+    monkeypatch.setattr(remynd, 'loads', loads)
+    loop = asyncio.new_event_loop()
+    host = remynd.Host(loop)
+    centers = [remynd.MessageCenter(loop) for _ in range(3)]
+    for message_center in centers:
+        host.add(message_center)
+    responses = [message_center._expect_response({}, None) for message_center in centers]
+
+    raw = json.dumps({"responseID": responses[1][0], "extensionID": centers[1].extension_id, "origin": "app", "data": {"ok": 1}})
+    host.triage_raw('messages', raw)
+    assert decoded == [raw]
+    assert responses[1][1].result() == {"ok": 1}
+    assert [c.metrics.counters.get('messages.received', 0) for c in centers] == [0, 1, 0]
+
+    # a response for an extension that isn't hosted here is dropped without decoding
+    host.triage_raw('messages', json.dumps({"responseID": "r", "extensionID": "other", "origin": "app", "data": {}}))
+    assert len(decoded) == 1
+
+
+def test_full_blocking_lane_still_receives_responses():
+    handled = []
+
+    async def main():
+        message_center = remynd.MessageCenter(asyncio.get_running_loop())
+        replies = []
+
+        async def handler(channel, event, msg):
+            response_id, reply = message_center._expect_response({}, None)
+            replies.append(response_id)
+            handled.append((msg['n'], await reply))
+        message_center.subscribe('recorder', 'didCaptureFrame', handler)
+        message_center.limit('recorder', policy='block', maxsize=2)
+
+        for n in range(4):
+            message_center.triage_raw('recorder', json.dumps({"event": "didCaptureFrame", "origin": "app", "data": {"n": n}}))
+        lane = message_center.lanes['recorder']
+        assert len(lane.items) == 2 and len(lane.held) == 2
+        # The reader keeps going: every reply reaches the handler that waits for it
+        for n in range(4):
+            await asyncio.sleep(0.01)
+            message_center.triage_raw('messages', json.dumps({"responseID": replies[n], "extensionID": message_center.extension_id,
+                                                              "origin": "app", "data": {"ok": n}}))
+        await asyncio.sleep(0.01)
+        assert not lane.held and lane.wait_for_space().done()
+
+    asyncio.run(main())
+    assert handled == [(n, {"ok": n}) for n in range(4)]
+
+
+def test_sql_inlines_escaped_literals(monkeypatch):
+    sent = []
+
+    class Center:
+        async def send_message(self, msg):
+            sent.append(msg['data'])
+            return {"result": [{"id": 1, "participants": '["John O\'Galt"]'}]}
+
+    rows = asyncio.run(remynd.sql(Center(), "select * from Call -- newest first\n  where id < ? and title = ? and x is ?",
+                                  (5, "O'Galt", None), db="extras", json_columns=('participants',)))
+    assert sent == [{"sql": "select * from Call -- newest first\n  where id < 5 and title = 'O''Galt' and x is NULL", "db": "extras"}]
+    assert rows == [{"id": 1, "participants": ["John O'Galt"]}]
+
+    monkeypatch.setattr(remynd, 'sql_params', True)
+    asyncio.run(remynd.sql(Center(), "select * from Call where id < ?", (5,)))
+    assert sent[-1] == {"sql": "select * from Call where id < ?", "params": [5]}
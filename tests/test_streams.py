@@ -0,0 +1,96 @@
+# MessageCenter streams transport against fakeredis: python -m pytest tests
+import asyncio
+import json
+import os
+import sys
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'copilot'))
+import remynd
+
+
+@pytest.fixture
+def client():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    # fakeredis returns nothing from a blocking XREADGROUP, read without blocking instead
+    xreadgroup = client.xreadgroup
+
+    async def nonblocking(*args, block=None, **kwargs):
+        await asyncio.sleep(0.01)
+        return await xreadgroup(*args, **kwargs)
+    client.xreadgroup = nonblocking
+    remynd._client = client
+    yield client
+    remynd._client = None
+
+
+def tick(n):
+    return {"msg": json.dumps({"event": "tick", "origin": "app", "data": {"n": n}})}
+
+
+def test_unacknowledged_entries_are_replayed_once_and_acknowledged(client):
+    calls = []
+
+    async def main():
+        message_center = remynd.MessageCenter(asyncio.get_running_loop(), transport='streams')
+        group = message_center.extension_id
+
+        async def handler(channel, event, msg):
+            calls.append(msg['n'])
+            await asyncio.sleep(0.5)
+        message_center.subscribe('ui', 'tick', handler)
+
+        # Entries read by a previous run that stopped before acknowledging them
+        await message_center._join_streams()
+        for n in range(3):
+            await client.xadd('stream:ui', tick(n))
+        await client.xreadgroup(group, group, {'stream:ui': '>'})
+
+        reader = asyncio.create_task(message_center._read_streams())
+        await asyncio.sleep(0.1)
+        await client.xadd('stream:ui', tick(3))
+        await asyncio.sleep(0.1)
+        # Reconnect while the handlers still run: they are not dispatched again
+        reader.cancel()
+        reader = asyncio.create_task(message_center._read_streams())
+        await asyncio.sleep(0.5)
+        assert sorted(calls) == [0, 1, 2, 3]
+        assert (await client.xpending('stream:ui', group))['pending'] == 0
+        reader.cancel()
+
+    asyncio.run(main())
+
+
+def test_full_blocking_lane_holds_back_only_its_stream(client):
+    calls = []
+
+    async def main():
+        message_center = remynd.MessageCenter(asyncio.get_running_loop(), transport='streams', stream_batch=1)
+        group = message_center.extension_id
+        replies = []
+
+        async def handler(channel, event, msg):
+            response_id, reply = message_center._expect_response({}, None)
+            replies.append(response_id)
+            calls.append((msg['n'], await reply))
+        message_center.subscribe('ui', 'tick', handler)
+        message_center.limit('ui', policy='block', maxsize=1)
+
+        await message_center._join_streams()
+        for n in range(6):
+            await client.xadd('stream:ui', tick(n))
+        reader = asyncio.create_task(message_center._read_streams())
+        for n in range(6):
+            await asyncio.sleep(0.1)
+            # One entry waits for its reply, one is queued, one held: the rest stays in the stream
+            assert (await client.xpending('stream:ui', group))['pending'] <= 3
+            await client.xadd('stream:messages', {"msg": json.dumps({"responseID": replies[n], "extensionID": group,
+                                                                     "origin": "app", "data": {"ok": n}})})
+        await asyncio.sleep(0.1)
+        assert calls == [(n, {"ok": n}) for n in range(6)]
+        assert (await client.xpending('stream:ui', group))['pending'] == 0
+        reader.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+# Compares the JSON codecs supported by remynd (json, orjson, msgspec) on
+# message payloads shaped like the examples in README.md.
+#
+#   python tools/bench_codec.py
+#   python tools/bench_codec.py --repeat 2000 --ext copilot
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from base64 import b64encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="remynd JSON codec benchmark")
+parser.add_argument('--ext', default='copilot', help="extension directory to import remynd from")
+parser.add_argument('--repeat', type=int, default=1000)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(ROOT, args.ext))
+import remynd
+
+def ocr_payload():
+    # 'didCaptureOCR' example from the recorder channel docs, with a real icon
+    with open(os.path.join(ROOT, 'README.md')) as f:
+        text = re.search(r"'text': '(EURUSD=X.*?)'\n", f.read()).group(1).replace('\\n', '\n')
+    with open(os.path.join(ROOT, 'copilot/assets/images/5a3187eb-90c8-4a0e-bf98-bb293ba809a6.png'), 'rb') as f:
+        icon = b64encode(f.read()).decode('ascii')
+    return {
+        "event": "didCaptureOCR",
+        "origin": "app",
+        "data": {
+            "id": 24625,
+            "title": "EURUSD=X",
+            "url": None,
+            "appIcon": icon,
+            "timestamp": 1717688799.6166666,
+            "position": 1030613279770,
+            "appName": "Stocks",
+            "bundleID": "com.apple.stocks",
+            "text": text,
+        }
+    }
+
+def render_payload():
+    # 'ui.renderHTML' request carrying a rendered copilot page
+    html = ""
+    for name in sorted(os.listdir(os.path.join(ROOT, 'copilot/templates'))):
+        with open(os.path.join(ROOT, 'copilot/templates', name)) as f:
+            html += f.read()
+    return {
+        "event": "ui.renderHTML",
+        "responseID": "2b0d4f1e-6f7e-4a37-9a51-0f3c2b8f61a4",
+        "extensionID": "copilot",
+        "origin": "extension",
+        "data": {"html": html, "width": 420, "height": 600, "reopen": True, "windowTag": "main"}
+    }
+
+def sql_payload():
+    # 'sql.runSQL' response with transcription rows
+    rows = [{
+        "id": 1000 + i,
+        "startTimestamp": f"2024-05-17 15:{i // 60:02d}:{i % 60:02d}.425",
+        "text": "John mentions that the scheduling issue in the codebase still needs a few more days of work.",
+    } for i in range(100)]
+    return {"event": "sql.runSQL", "responseID": "0c7e0b59-2d0f-4a55-8a2b-0d7a0b1f3e11", "data": rows}
+
+def timed(fn, value):
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        fn(value)
+    return (time.perf_counter() - started) / args.repeat * 1e6
+
+payloads = {"didCaptureOCR": ocr_payload(), "ui.renderHTML": render_payload(), "sql.runSQL": sql_payload()}
+
+for codec in ('json', 'orjson', 'msgspec'):
+    try:
+        remynd.use_codec(codec)
+    except ValueError:
+        print(json.dumps({"codec": codec, "available": False}), flush=True)
+        continue
+    for name, payload in payloads.items():
+        encoded = remynd.dumps(payload)
+        # messages arrive from redis-py as str (decode_responses=True)
+        text = encoded if isinstance(encoded, str) else encoded.decode('utf-8')
+        print(json.dumps({
+            "codec": codec,
+            "payload": name,
+            "bytes": len(text.encode('utf-8')),
+            "dumps_us": round(timed(remynd.dumps, payload), 2),
+            "loads_us": round(timed(remynd.loads, text), 2),
+        }), flush=True)
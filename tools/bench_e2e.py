@@ -0,0 +1,291 @@
+# End-to-end benchmark of the remynd protocol against a local Redis and a responder stub
+# running in its own process:
+#   - send_message round-trip latency and throughput by payload size and concurrency
+#   - MessageCenter.triage_raw dispatch cost
+#   - Dictionary operation latency
+# Every result is printed as one JSON object per line.
+#
+#   python tools/bench_e2e.py --fake                 # in-process fakeredis server
+#   REDIS_PORT=6379 python tools/bench_e2e.py > results.jsonl
+#   python tools/bench_e2e.py --payloads tiny,html --concurrency 1,100 --requests 500
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import timeit
+from base64 import b64encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="remynd end-to-end benchmark")
+parser.add_argument('--fake', action='store_true', help="start a fakeredis TCP server as the Redis stand-in")
+parser.add_argument('--port', default=os.environ.get('REDIS_PORT', '6381'), help="TCP port or unix socket path")
+parser.add_argument('--ext', default='copilot', help="extension directory to import remynd from")
+parser.add_argument('--transport', choices=('pubsub', 'streams'), default='pubsub')
+parser.add_argument('--directed', action='store_true', help="ask for responses on the extension's own inbox channel")
+parser.add_argument('--payloads', default='tiny,html,frame,1mb')
+parser.add_argument('--concurrency', default='1,10,100,1000')
+parser.add_argument('--requests', type=int, default=300, help="requests per payload and concurrency level")
+parser.add_argument('--skip', default='', help="comma separated sections to skip: rtt,triage,dictionary")
+args = parser.parse_args()
+
+if args.fake:
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', int(args.port)), server_type='redis')
+    # the responder process keeps its connection open until it is terminated
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+os.environ['REDIS_PORT'] = args.port
+sys.path.insert(0, os.path.join(ROOT, args.ext))
+import remynd
+
+def payloads():
+    with open(os.path.join(ROOT, 'copilot/templates/call.html')) as f:
+        html = f.read()
+    # a screen frame is a few hundred KB of PNG data, random bytes don't compress either
+    frame = b64encode(random.Random(0).randbytes(192 * 1024)).decode('ascii')
+    return {
+        "tiny": "x" * 64,
+        "html": html,
+        "frame": frame,
+        "1mb": "x" * (1024 * 1024),
+    }
+
+# Responder stub, runs in a separate process: 'bench.upload' carries the payload in the
+# request (like ui.renderHTML), 'bench.download' asks for a payload in the response (like
+# recorder.getFrame).
+def responder(port, transport, ready):
+    import redis.asyncio as redis
+
+    async def serve():
+        if port.isdigit():
+            pool = redis.BlockingConnectionPool(host='localhost', port=int(port), max_connections=64, decode_responses=True)
+        else:
+            pool = redis.BlockingConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=port,
+                                                max_connections=64, decode_responses=True)
+        r = redis.Redis(connection_pool=pool)
+        blobs = {}
+        # the stub sends no events, it directs all of them to an extension's inbox right away
+        directed = set()
+
+        async def reply(msg):
+            data = msg.get('data') or {}
+            if msg['event'] == 'bench.download':
+                size = data['size']
+                blob = blobs.get(size) or blobs.setdefault(size, 'x' * size)
+                result = {"blob": blob}
+            else:
+                result = {"size": len(data.get('blob', ''))}
+            out = json.dumps({"responseID": msg['responseID'], "extensionID": msg['extensionID'], "origin": "app", "data": result})
+            channel = msg.get('replyChannel', 'messages')
+            if channel != 'messages' and channel not in directed:
+                directed.add(channel)
+                signal = json.dumps({"event": "directed", "extensionID": msg['extensionID'], "origin": "app"})
+                if transport == 'streams':
+                    await r.xadd(f"stream:{channel}", {'msg': signal}, maxlen=10000, approximate=True)
+                else:
+                    await r.publish(channel, signal)
+            if transport == 'streams':
+                await r.xadd(f"stream:{channel}", {'msg': out}, maxlen=10000, approximate=True)
+            else:
+                await r.publish(channel, out)
+
+        def handle(raw):
+            msg = json.loads(raw)
+            if msg.get('origin') == 'extension' and str(msg.get('event')).startswith('bench.'):
+                asyncio.get_running_loop().create_task(reply(msg))
+
+        if transport == 'streams':
+            try:
+                await r.xgroup_create('stream:messages', 'bench', id='$', mkstream=True)
+            except redis.ResponseError:
+                pass
+            ready.set()
+            while True:
+                batch = await r.xreadgroup('bench', 'bench', {'stream:messages': '>'}, count=1000, block=1000)
+                for _, entries in batch or []:
+                    for _, fields in entries:
+                        handle(fields['msg'])
+                    await r.xack('stream:messages', 'bench', *[entry_id for entry_id, _ in entries])
+        pubsub = r.pubsub()
+        await pubsub.subscribe('messages')
+        ready.set()
+        while True:
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if msg:
+                handle(msg['data'])
+
+    asyncio.run(serve())
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def emit(result):
+    print(json.dumps(result), flush=True)
+
+async def bench_rtt(message_center, name, payload, direction, concurrency):
+    latencies = []
+    errors = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            if direction == 'upload':
+                msg = {"event": "bench.upload", "data": {"blob": payload}}
+            else:
+                msg = {"event": "bench.download", "data": {"size": len(payload)}}
+            started = time.perf_counter()
+            try:
+                await message_center.send_message(msg, timeout=30)
+            except (remynd.RequestTimeout, remynd.ConnectionLost) as e:
+                # e.g. the server dropping a subscriber over client-output-buffer-limit
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    # warm up the connection pool and the responder
+    await asyncio.gather(*(one() for _ in range(min(concurrency, 10))))
+    latencies.clear()
+    errors.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    if not latencies:
+        emit({"bench": "rtt", "payload": name, "direction": direction, "concurrency": concurrency, "errors": errors})
+        return
+    emit({
+        "bench": "rtt",
+        "transport": message_center.transport,
+        "directed": message_center.directed,
+        "codec": remynd.codec,
+        "payload": name,
+        "bytes": len(payload),
+        "direction": direction,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "req_per_s": round(len(latencies) / elapsed, 1),
+        "mb_per_s": round(len(latencies) * len(payload) / elapsed / 1e6, 2),
+        "errors": errors,
+    })
+
+async def bench_triage(loop):
+    message_center = remynd.MessageCenter(loop)
+
+    async def handler(channel, event, msg):
+        pass
+
+    message_center.subscribe('system', 'keyUp', handler)
+    html = payloads()['html']
+    cases = {
+        "handled": ('system', {"event": "keyUp", "origin": "app", "data": {"timestamp": 1703012654.5}}),
+        "unhandled_event": ('system', {"event": "mouseMoved", "origin": "app", "data": {"timestamp": 1703012654.5}}),
+        "own_echo": ('messages', {"event": "ui.renderHTML", "origin": "extension", "extensionID": message_center.extension_id,
+                                  "responseID": "r", "data": {"html": html}}),
+        "other_extension": ('messages', {"responseID": "r", "extensionID": "other", "origin": "app", "data": {"html": html}}),
+    }
+    number = 20000
+    for name, (channel, msg) in cases.items():
+        raw = json.dumps(msg)
+        seconds = timeit.timeit(lambda: message_center.triage_raw(channel, raw), number=number)
+        # let the spawned handler tasks finish before the next case
+        await asyncio.sleep(0)
+        while message_center.running:
+            await asyncio.sleep(0.01)
+        emit({"bench": "triage", "case": name, "bytes": len(raw), "us_per_msg": round(seconds / number * 1e6, 3)})
+
+# The cache needs CONFIG to check keyspace notifications, fakeredis has no CONFIG command
+async def has_config(client):
+    import redis
+    try:
+        await client.config_get('notify-keyspace-events')
+        return True
+    except redis.ResponseError:
+        # and its server closes the connection after an unknown command
+        await client.connection_pool.disconnect()
+        return False
+
+async def bench_dictionary():
+    value = {"id": 1703024824, "participants": ["John Galt", "Jonathan Livingston"], "title": "Meeting"}
+    for options in ({}, {"cache": True}, {"write_behind": True}):
+        # the bench owns its Redis server, it may turn on keyspace notifications
+        kvstore = remynd.Dictionary('bench', notify_config=True, **options)
+        if 'cache' in options and not await has_config(kvstore.r):
+            emit({"bench": "dictionary", "options": "cache", "skipped": "the server has no CONFIG command"})
+            continue
+        await kvstore.remove('list')
+        ops = {
+            "set": lambda: kvstore.set('key', 'value'),
+            "get": lambda: kvstore.get('key'),
+            "set_json": lambda: kvstore.set_json('json', value),
+            "get_json": lambda: kvstore.get_json('json'),
+            "increment": lambda: kvstore.increment('counter'),
+            "append_json": lambda: kvstore.append_json('list', value, maxlen=100),
+            "range_json": lambda: kvstore.range_json('list', -10),
+        }
+        # With write_behind, set/get/set_json/get_json only touch the local buffer (get reads
+        # the key just buffered). set_flush also sends the write to Redis.
+        buffered = ()
+        if 'write_behind' in options:
+            buffered = ('set', 'get', 'set_json', 'get_json')
+            ops["set_flush"] = lambda: set_flush(kvstore)
+        for name, op in ops.items():
+            latencies = []
+            for _ in range(1000):
+                started = time.perf_counter()
+                await op()
+                latencies.append(time.perf_counter() - started)
+            emit({
+                "bench": "dictionary",
+                "options": ','.join(options) or "plain",
+                "op": name,
+                "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+                "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+                **({"buffer_only": True} if name in buffered else {}),
+            })
+        await kvstore.flush()
+        for key in ('key', 'json', 'counter', 'list'):
+            await kvstore.remove(key)
+        await kvstore.flush()
+
+async def set_flush(kvstore):
+    await kvstore.set('key', 'value')
+    await kvstore.flush()
+
+async def main():
+    loop = asyncio.get_running_loop()
+    skip = set(args.skip.split(','))
+
+    if 'rtt' not in skip:
+        ready = multiprocessing.Event()
+        stub = multiprocessing.Process(target=responder, args=(args.port, args.transport, ready), daemon=True)
+        stub.start()
+        ready.wait(10)
+
+        message_center = remynd.MessageCenter(loop, transport=args.transport, directed=args.directed, stream_maxlen=100000)
+        listener = loop.create_task(message_center.listen_for_messages())
+        await asyncio.sleep(0.2)
+        data = payloads()
+        for name in args.payloads.split(','):
+            for direction in ('upload', 'download'):
+                for concurrency in map(int, args.concurrency.split(',')):
+                    await bench_rtt(message_center, name, data[name], direction, concurrency)
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        stub.terminate()
+
+    if 'triage' not in skip:
+        await bench_triage(loop)
+    if 'dictionary' not in skip:
+        await bench_dictionary()
+
+asyncio.run(main())
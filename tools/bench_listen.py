@@ -0,0 +1,85 @@
+# Measures MessageCenter dispatch latency (publish -> handler start) for the
+# push-based reader and the legacy polling reader.
+#
+#   python tools/bench_listen.py --fake            # in-process fakeredis server
+#   REDIS_PORT=6379 python tools/bench_listen.py   # any local Redis
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="MessageCenter dispatch latency benchmark")
+parser.add_argument('--fake', action='store_true', help="start a fakeredis TCP server as the Redis stand-in")
+parser.add_argument('--port', type=int, default=int(os.environ.get('REDIS_PORT', 6381)))
+parser.add_argument('--ext', default='demo', help="extension directory to import remynd from")
+parser.add_argument('--bursts', type=int, default=50)
+parser.add_argument('--burst-size', type=int, default=20)
+parser.add_argument('--idle', type=float, default=0.05, help="pause between bursts (seconds)")
+args = parser.parse_args()
+
+if args.fake:
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', args.port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+os.environ['REDIS_PORT'] = str(args.port)
+sys.path.insert(0, os.path.join(ROOT, args.ext))
+import remynd
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def run_mode(loop, push):
+    latencies = []
+    done = asyncio.Event()
+    expected = args.bursts * args.burst_size
+
+    async def handler(channel, event, msg):
+        latencies.append(time.perf_counter() - msg['sent'])
+        if len(latencies) == expected:
+            done.set()
+
+    message_center = remynd.MessageCenter(loop, push=push)
+    message_center.subscribe('system', handler)
+    listener = loop.create_task(message_center.listen_for_messages())
+    await asyncio.sleep(0.2)
+
+    publisher = remynd.redis.Redis(host='localhost', port=args.port, decode_responses=True)
+    started = time.perf_counter()
+    for _ in range(args.bursts):
+        async with publisher.pipeline(transaction=False) as pipe:
+            for _ in range(args.burst_size):
+                msg = {"event": "keyUp", "origin": "app", "data": {"sent": time.perf_counter()}}
+                pipe.publish('system', json.dumps(msg))
+            await pipe.execute()
+        await asyncio.sleep(args.idle)
+
+    await asyncio.wait_for(done.wait(), 30)
+    elapsed = time.perf_counter() - started
+
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
+    await message_center.pubsub.aclose()
+    await publisher.aclose()
+
+    return {
+        "reader": "push" if push else "poll",
+        "messages": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "elapsed_s": round(elapsed, 3),
+    }
+
+async def main():
+    loop = asyncio.get_running_loop()
+    for push in (False, True):
+        print(json.dumps(await run_mode(loop, push)), flush=True)
+
+asyncio.run(main())
@@ -0,0 +1,61 @@
+# Measures Redis round-trip latency through the remynd connection pool, over TCP and
+# (when the server has `unixsocket` configured) over a unix socket.
+#
+#   python tools/bench_rtt.py --port 6381 --socket /tmp/redis.sock
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="Redis round-trip latency benchmark")
+parser.add_argument('--port', default=os.environ.get('REDIS_PORT', '6381'))
+parser.add_argument('--socket', help="unix socket path of the same server")
+parser.add_argument('--ext', default='demo', help="extension directory to import remynd from")
+parser.add_argument('--requests', type=int, default=5000)
+parser.add_argument('--concurrency', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(ROOT, args.ext))
+import remynd
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def run(address):
+    os.environ['REDIS_PORT'] = address
+    remynd.configure()
+    kvstore = remynd.Dictionary('bench')
+    await kvstore.set('rtt', 'x' * 100)
+    latencies = []
+
+    async def worker(n):
+        for _ in range(n):
+            started = time.perf_counter()
+            await kvstore.get('rtt')
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(args.requests // args.concurrency) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    await kvstore.remove('rtt')
+    await remynd.connection().aclose()
+
+    return {
+        "transport": "tcp" if address.isdigit() else "unix",
+        "requests": len(latencies),
+        "concurrency": args.concurrency,
+        "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+        "ops_per_s": round(len(latencies) / elapsed),
+    }
+
+async def main():
+    for address in [args.port] + ([args.socket] if args.socket else []):
+        print(json.dumps(await run(address)), flush=True)
+
+asyncio.run(main())
@@ -0,0 +1,63 @@
+# Runs several extensions in one Python process. Each keeps its own extension_id (the `id`
+# from its manifest.json, or dir=EXTENSION_ID) and Dictionary namespace. They share the Redis
+# connection pool, one pubsub reader (remynd.Host) and a single import of remynd, jinja2 and
+# every other module they have in common.
+#
+#   python tools/host.py copilot immersion huddle
+#   python tools/host.py --port /tmp/redis.sock copilot=copilot demo_ui=demo_ui
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="Run several ReMynd extensions in one process")
+parser.add_argument('extensions', nargs='+', help="extension directories, optionally as dir=EXTENSION_ID")
+parser.add_argument('--port', default=os.environ.get('REDIS_PORT', '6381'), help="TCP port or unix socket path")
+args = parser.parse_args()
+os.environ['REDIS_PORT'] = args.port
+
+extensions = []
+for arg in args.extensions:
+    path, _, extension_id = arg.partition('=')
+    if not os.path.isdir(path):
+        path = os.path.join(ROOT, path)
+    path = os.path.abspath(path)
+    if not extension_id:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            extension_id = json.load(f)['id']
+    extensions.append((path, extension_id))
+
+# Every extension directory is importable, the first one listed wins for modules they share
+for path, _ in reversed(extensions):
+    sys.path.insert(0, path)
+import remynd
+
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+remynd.host = remynd.Host(loop)
+
+for path, extension_id in extensions:
+    # Loaded as 'main' like when the app starts it, jinja2's PackageLoader("main") looks it up
+    spec = importlib.util.spec_from_file_location('main', os.path.join(path, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['main'] = module
+    remynd.hosting = extension_id
+    try:
+        # Top-level code subscribes its handlers, message_center.run() only registers the center
+        spec.loader.exec_module(module)
+    except Exception:
+        remynd.log(f"Failed to load {os.path.basename(path)}:", traceback.format_exc(), level='error')
+    else:
+        remynd.log(f"Loaded {os.path.basename(path)} as {extension_id}")
+    finally:
+        remynd.hosting = None
+        del sys.modules['main']
+
+if not remynd.host.centers:
+    sys.exit("No extension started")
+remynd.host.run()
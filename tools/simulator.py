@@ -0,0 +1,319 @@
+# Stands in for the ReMynd app, so extensions can run headless on Linux.
+#
+# Answers the requests described in README.md (sql.runSQL from a SQLite fixture with Call,
+# TranscriptionSegment and FrameOCR tables, ui.renderHTML, recorder.getFrameOCR, ai.query, ...)
+# after a configurable latency, and publishes app events from a recorded trace or a
+# synthetic load on the system/recorder/calls/ui channels.
+#
+#   python tools/simulator.py --fake                         # in-process fakeredis server
+#   python tools/simulator.py --latency ai.query=2 --scale 0.5
+#   python tools/simulator.py --record trace.jsonl           # record events from a real app
+#   python tools/simulator.py --replay trace.jsonl --rate 4  # replay them 4x faster
+#   python tools/simulator.py --synthetic 50                 # 50 input events per second
+#
+# Then start an extension against the same server:
+#   cd copilot && REDIS_PORT=6381 EXTENSION_ID=copilot python main.py
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from base64 import b64encode
+from datetime import datetime
+
+import redis.asyncio as redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds before each kind of request is answered, scaled by --scale
+LATENCY = {
+    'sql.runSQL': 0.003,
+    'ui.renderHTML': 0.025,
+    'recorder.getFrame': 0.03,
+    'recorder.getFrameOCR': 0.015,
+    'ai.query': 1.5,
+    'workflow.run': 3.0,
+    'edb.runEdgeQL': 0.005,
+}
+DEFAULT_LATENCY = 0.002
+
+PEOPLE = ["John Galt", "Jonathan Livingston", "Steve Jobs", "Steve Ballmer", "Stacy Moore", "David Kim", "Robert Lee"]
+APPS = [("Zoom", "us.zoom.xos"), ("Slack", "com.tinyspeck.slackmacgap"), ("Safari", "com.apple.Safari"),
+        ("Stocks", "com.apple.stocks"), ("Xcode", "com.apple.dt.Xcode")]
+WORDS = ("the scheduling issue in the codebase still needs a few more days of work and "
+         "we should follow up with ACME about shipping supplies before the settings panel ships").split()
+
+def create_fixture(path, calls=50, segments=200, frames=2000, seed=1):
+    rnd = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.executescript("""
+        DROP TABLE IF EXISTS Call;
+        DROP TABLE IF EXISTS TranscriptionSegment;
+        DROP TABLE IF EXISTS FrameOCR;
+        CREATE TABLE Call (id INTEGER PRIMARY KEY, callID INTEGER, appName TEXT, title TEXT,
+            participants TEXT, startDate REAL, endDate REAL, meetingId INTEGER);
+        CREATE TABLE TranscriptionSegment (id INTEGER PRIMARY KEY AUTOINCREMENT, callID INTEGER,
+            startTimestamp REAL, endTimestamp REAL, speaker TEXT, text TEXT);
+        CREATE INDEX TranscriptionSegmentCall ON TranscriptionSegment (callID, id);
+        CREATE TABLE FrameOCR (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL, position INTEGER,
+            appName TEXT, bundleID TEXT, title TEXT, url TEXT, text TEXT);
+        CREATE INDEX FrameOCRTimestamp ON FrameOCR (timestamp);
+    """)
+    start = time.time() - calls * 86400 / 4
+    for _ in range(calls):
+        start += rnd.uniform(3600, 43200)
+        duration = rnd.uniform(60, 3600)
+        participants = rnd.sample(PEOPLE, rnd.randint(2, 5))
+        call_id = int(start)
+        db.execute("INSERT INTO Call VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            call_id, call_id, "Zoom", f"{participants[0]}'s Personal Meeting Room",
+            json.dumps(participants), start, start + duration, rnd.randint(10**9, 10**10)))
+        for i in range(segments):
+            ts = start + duration * i / segments
+            db.execute("INSERT INTO TranscriptionSegment (callID, startTimestamp, endTimestamp, speaker, text) VALUES (?, ?, ?, ?, ?)", (
+                call_id, ts, ts + duration / segments, rnd.choice(participants),
+                ' '.join(rnd.choices(WORDS, k=rnd.randint(5, 25))).capitalize() + '.'))
+    ts = time.time() - frames * 2
+    for _ in range(frames):
+        ts += 2
+        app, bundle = rnd.choice(APPS)
+        db.execute("INSERT INTO FrameOCR (timestamp, position, appName, bundleID, title, url, text) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            ts, int(ts * 600), app, bundle, f"{app} window", None, '\n'.join(rnd.choices(WORDS, k=rnd.randint(20, 200)))))
+    db.commit()
+    db.close()
+
+def _image(name):
+    with open(os.path.join(ROOT, 'copilot/assets/images', name), 'rb') as f:
+        return b64encode(f.read()).decode('ascii')
+
+class Simulator:
+    def __init__(self, r, db_path, latency, scale=1.0, transport='pubsub'):
+        self.r = r
+        self.db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.latency = latency
+        self.scale = scale
+        self.transport = transport
+        self.windows = 0
+        self.icon = _image('5a3187eb-90c8-4a0e-bf98-bb293ba809a6.png')
+        self.frame = _image('0293f564-c2f5-4474-9dc5-9896c251ec8f.png')
+        # event -> number of requests answered
+        self.answered = {}
+        self.tasks = set()
+
+    async def publish(self, channel, msg):
+        data = json.dumps(msg)
+        if self.transport == 'streams':
+            await self.r.xadd(f"stream:{channel}", {'msg': data}, maxlen=10000, approximate=True)
+        else:
+            await self.r.publish(channel, data)
+
+    async def event(self, channel, event, data, extension_id=None):
+        msg = {"event": event, "origin": "app", "data": data}
+        if extension_id:
+            msg["extensionID"] = extension_id
+        await self.publish(channel, msg)
+
+    # Reads extension requests and answers each of them in its own task
+    async def serve(self):
+        if self.transport == 'streams':
+            try:
+                await self.r.xgroup_create('stream:messages', 'app', id='$', mkstream=True)
+            except redis.ResponseError:
+                pass
+            while True:
+                batch = await self.r.xreadgroup('app', 'app', {'stream:messages': '>'}, count=100, block=5000)
+                for _, entries in batch or []:
+                    for entry_id, fields in entries:
+                        self._request(fields.get('msg'))
+                    await self.r.xack('stream:messages', 'app', *[entry_id for entry_id, _ in entries])
+        pubsub = self.r.pubsub()
+        await pubsub.subscribe('messages')
+        while True:
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if msg:
+                self._request(msg['data'])
+
+    def _request(self, raw):
+        try:
+            msg = json.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if msg.get('origin') != 'extension' or not msg.get('responseID'):
+            return
+        task = asyncio.get_running_loop().create_task(self._answer(msg))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _answer(self, msg):
+        event = msg.get('event')
+        await asyncio.sleep(self.latency.get(event, DEFAULT_LATENCY) * self.scale)
+        handler = getattr(self, 'on_' + (event or '').replace('.', '_'), None)
+        try:
+            data = handler(msg.get('data') or {}) if handler else "OK"
+        except Exception as e:
+            data = {"error": str(e)}
+        self.answered[event] = self.answered.get(event, 0) + 1
+        await self.publish(msg.get('replyChannel', 'messages'), {
+            "responseID": msg['responseID'],
+            "extensionID": msg.get('extensionID'),
+            "origin": "app",
+            "data": data
+        })
+
+    def on_sql_runSQL(self, data):
+        # params only come with remynd.sql_params = True, sqlite3 then reuses statements by text
+        rows = self.db.execute(data['sql'], data.get('params') or ()).fetchmany(100)
+        return {"result": [dict(row) for row in rows]}
+
+    def on_ui_renderHTML(self, data):
+        if data.get('windowID'):
+            return {"windowID": data['windowID']}
+        self.windows += 1
+        return {"windowID": self.windows}
+
+    def on_ui_showNotification(self, data):
+        return {"notificationID": str(uuid.uuid4()).upper()}
+
+    def on_recorder_getFrame(self, data):
+        return {"imageData": self.frame}
+
+    def on_recorder_getFrameOCR(self, data):
+        timestamp = data.get('timestamp') or data.get('position', 0) / 600
+        row = self.db.execute("SELECT * FROM FrameOCR ORDER BY abs(timestamp - ?) LIMIT 1", (timestamp,)).fetchone()
+        if row is None:
+            return {}
+        return dict(row, appIcon=self.icon)
+
+    def on_ai_query(self, data):
+        words = data.get('text', '').split()
+        return {"text": ' '.join(words[:12]) or "Nothing to summarize", "tokens": len(words), "cost": len(words) * 1e-5}
+
+    def on_workflow_run(self, data):
+        return {"output": json.dumps([{"start": "", "end": "", "title": "Simulated topic", "summary": "Simulated summary."}])}
+
+    def on_edb_runEdgeQL(self, data):
+        return []
+
+    def on_system_getLocale(self, data):
+        return ["en_US"]
+
+    def on_system_getRunningApps(self, data):
+        return {"runningApps": [{"appName": app, "bundleID": bundle, "pid": 1000 + i, "isActive": i == 0}
+                                for i, (app, bundle) in enumerate(APPS)]}
+
+    def on_ax_getProcessTree(self, data):
+        return {"windows": []}
+
+    # Publishes trace events with their original spacing divided by rate
+    async def replay(self, path, rate=1.0, repeat=False):
+        with open(path) as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+        while True:
+            started = time.monotonic()
+            for entry in trace:
+                delay = started + entry.get('t', 0) / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.publish(entry['channel'], entry['msg'])
+            if not repeat:
+                return
+
+    # Input events at `rate` per second, a frame capture every second, a call every minute
+    async def synthetic(self, rate):
+        rnd = random.Random(2)
+        n = 0
+        while True:
+            await asyncio.sleep(1 / rate)
+            n += 1
+            now = time.time()
+            await self.event('system', rnd.choice(('keyUp', 'leftMouseUp', 'scrollWheel')), {"timestamp": now})
+            if n % max(1, int(rate)) == 0:
+                await self.event('recorder', 'didCaptureFrame', {"timestamp": now, "position": int(now * 600)})
+            if n % max(1, int(rate * 60)) == 0:
+                call = self.db.execute("SELECT * FROM Call ORDER BY random() LIMIT 1").fetchone()
+                if call:
+                    call = dict(call, participants=json.loads(call['participants']))
+                    await self.event('calls', 'callDidStart', call)
+                    await self.event('calls', 'callDidEnd', call)
+
+# Writes every app event seen on Redis to a trace file (one JSON object per line)
+async def record(r, path):
+    pubsub = r.pubsub()
+    await pubsub.psubscribe('*')
+    started = time.monotonic()
+    with open(path, 'w') as f:
+        while True:
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if not msg:
+                continue
+            try:
+                data = json.loads(msg['data'])
+            except ValueError:
+                continue
+            if isinstance(data, dict) and data.get('origin') == 'app' and not data.get('responseID'):
+                f.write(json.dumps({"t": round(time.monotonic() - started, 3), "channel": msg['channel'], "msg": data}) + '\n')
+                f.flush()
+
+async def report(sim, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps({"time": datetime.now().isoformat(), "answered": sim.answered, "inflight": len(sim.tasks)}), flush=True)
+
+async def main(args):
+    if args.address.isdigit():
+        r = redis.Redis(host='localhost', port=int(args.address), decode_responses=True)
+    else:
+        r = redis.Redis(unix_socket_path=args.address, decode_responses=True)
+    if args.record:
+        await record(r, args.record)
+        return
+
+    if args.fixture or not os.path.exists(args.db):
+        create_fixture(args.db, calls=args.calls, segments=args.segments, frames=args.frames)
+
+    latency = dict(LATENCY)
+    for item in args.latency:
+        event, seconds = item.split('=')
+        latency[event] = float(seconds)
+
+    sim = Simulator(r, args.db, latency, args.scale, args.transport)
+    tasks = [sim.serve(), report(sim, args.report)]
+    if args.replay:
+        tasks.append(sim.replay(args.replay, args.rate, args.repeat))
+    if args.synthetic:
+        tasks.append(sim.synthetic(args.synthetic))
+    print(f"Simulating ReMynd on {args.address} ({args.transport}), fixture {args.db}", flush=True)
+    await asyncio.gather(*tasks)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ReMynd app simulator")
+    parser.add_argument('--fake', action='store_true', help="start a fakeredis TCP server as the Redis stand-in")
+    parser.add_argument('--port', dest='address', default=os.environ.get('REDIS_PORT', '6381'), help="TCP port or unix socket path")
+    parser.add_argument('--transport', choices=('pubsub', 'streams'), default='pubsub')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'remynd-simulator.sqlite'))
+    parser.add_argument('--fixture', action='store_true', help="rebuild the SQLite fixture")
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--segments', type=int, default=200, help="transcription segments per call")
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--latency', action='append', default=[], metavar='EVENT=SECONDS')
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every latency")
+    parser.add_argument('--replay', help="trace file to publish")
+    parser.add_argument('--rate', type=float, default=1.0, help="replay speed")
+    parser.add_argument('--repeat', action='store_true', help="replay the trace forever")
+    parser.add_argument('--synthetic', type=float, help="synthetic input events per second")
+    parser.add_argument('--record', help="record app events to a trace file instead of simulating")
+    parser.add_argument('--report', type=float, default=10, help="seconds between status lines")
+    args = parser.parse_args()
+
+    if args.fake:
+        from fakeredis import TcpFakeServer
+        server = TcpFakeServer(('127.0.0.1', int(args.address)), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    asyncio.run(main(args))